@@ -0,0 +1,132 @@
+"""Limit archives built at once and queue the rest fairly between clients.
+
+Every client has its own line of waiting requests, a freed slot goes to
+the next client in turn, so one client downloading many albums can't
+hold back the others. When the line of the client or all the lines
+together are full, the request is rejected with a guess of when a slot
+could be free.
+"""
+
+import asyncio
+import bisect
+import math
+from collections import OrderedDict, deque
+from functools import partial
+
+WAIT_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300)  # seconds
+# Weight of the last build in the average time of builds
+BUILD_TIME_SMOOTHING = 0.2
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Queue is full, retry after {retry_after} s")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self, max_builds, max_queue, max_client_queue):
+        self.max_builds = max_builds
+        self.max_queue = max_queue
+        self.max_client_queue = max_client_queue
+        self.active = 0  # builds running now
+        self.waiters = OrderedDict()  # {client: deque of futures}, next first
+        self.queue_depth = 0
+        self.rejected = 0
+        self.build_seconds = 1.0  # average time a slot is held
+        # Waits per bucket, the last one is for waits above all
+        self.wait_counts = [0] * (len(WAIT_BUCKETS) + 1)
+        self.wait_sum = 0.0
+
+    def get_retry_after(self):
+        """Return seconds till the whole queue is likely to get slots"""
+        rounds = self.queue_depth / self.max_builds + 1
+        return max(1, math.ceil(self.build_seconds * rounds))
+
+    async def acquire(self, client):
+        """Wait for a free slot, return function to call when the build ends.
+
+        Raise QueueFullError if the client can't even wait.
+        """
+        loop = asyncio.get_event_loop()
+        started_at = loop.time()
+
+        if self.active < self.max_builds and not self.queue_depth:
+            self.active += 1
+        elif (
+            self.queue_depth >= self.max_queue
+            or len(self.waiters.get(client, ())) >= self.max_client_queue
+        ):
+            self.rejected += 1
+            raise QueueFullError(self.get_retry_after())
+        else:
+            waiter = loop.create_future()
+            self.waiters.setdefault(client, deque()).append(waiter)
+            self.queue_depth += 1
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.cancelled():
+                    self.discard(client, waiter)
+                else:
+                    # The slot was given right before the client had gone
+                    self.release()
+                raise
+
+        wait_seconds = loop.time() - started_at
+        self.wait_counts[bisect.bisect_left(WAIT_BUCKETS, wait_seconds)] += 1
+        self.wait_sum += wait_seconds
+        return partial(self.release, loop.time())
+
+    def discard(self, client, waiter):
+        waiters = self.waiters[client]
+        waiters.remove(waiter)
+        self.queue_depth -= 1
+        if not waiters:
+            del self.waiters[client]
+
+    def release(self, acquired_at=None):
+        if acquired_at is not None:
+            build_seconds = asyncio.get_event_loop().time() - acquired_at
+            self.build_seconds += BUILD_TIME_SMOOTHING * (
+                build_seconds - self.build_seconds
+            )
+        self.active -= 1
+
+        while self.active < self.max_builds and self.waiters:
+            client, waiters = next(iter(self.waiters.items()))
+            waiter = waiters.popleft()
+            self.queue_depth -= 1
+            if waiters:
+                self.waiters.move_to_end(client)
+            else:
+                del self.waiters[client]
+
+            self.active += 1
+            waiter.set_result(None)
+
+    def render_metrics(self):
+        """Return the state of the queue in Prometheus text format"""
+        lines = [
+            "# TYPE archive_builds_active gauge",
+            f"archive_builds_active {self.active}",
+            "# TYPE archive_builds_limit gauge",
+            f"archive_builds_limit {self.max_builds}",
+            "# TYPE archive_queue_depth gauge",
+            f"archive_queue_depth {self.queue_depth}",
+            "# TYPE archive_queue_limit gauge",
+            f"archive_queue_limit {self.max_queue}",
+            "# TYPE archive_queue_rejected_total counter",
+            f"archive_queue_rejected_total {self.rejected}",
+            "# TYPE archive_queue_wait_seconds histogram",
+        ]
+        cumulative_count = 0
+        for bucket, count in zip(WAIT_BUCKETS + ("+Inf",), self.wait_counts):
+            cumulative_count += count
+            lines.append(
+                f'archive_queue_wait_seconds_bucket{{le="{bucket}"}} '
+                f"{cumulative_count}"
+            )
+        lines.append(f"archive_queue_wait_seconds_sum {self.wait_sum}")
+        lines.append(f"archive_queue_wait_seconds_count {cumulative_count}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,194 @@
+"""Keep built archives on disk and give them to next clients as files.
+
+An archive is named by the fingerprint of its directory: names, sizes and
+modification times of the files. A changed album gets a new fingerprint,
+its old archive is left to be evicted when the cache is over its size,
+least recently used archives are evicted first.
+
+The first request for an archive starts its build in a background task,
+it writes the archive into a '.part' file. The client, and everyone asking
+for the same archive meanwhile, read that file behind the build, so the
+archive is built once however many clients wait for it.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+import aiofiles
+
+from zip_stream import list_files
+
+PART_SUFFIX = ".part"
+
+
+def get_fingerprint(path, salt=""):
+    """Return hash of names, sizes and modification times of all files"""
+    fingerprint = hashlib.sha1(salt.encode())
+    for file_path in list_files(path):
+        stat = os.stat(file_path)
+        relative_path = os.path.relpath(file_path, path)
+        fingerprint.update(
+            f"{relative_path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode()
+        )
+    return fingerprint.hexdigest()
+
+
+class ArchiveBuild:
+    """Archive being written to a file, readable while it grows"""
+
+    def __init__(self, path):
+        self.path = path
+        self.part_path = path + PART_SUFFIX
+        self.size = 0  # bytes written so far
+        self.done = False
+        self.error = None
+        self.grown = asyncio.Event()
+        self.task = None
+
+    def notify(self):
+        # Readers wait on the old event, the next growth gets a new one
+        self.grown.set()
+        self.grown = asyncio.Event()
+
+    async def write(self, archive_chunks):
+        # Unbuffered, so readers of the file see every chunk once it's counted
+        async with aiofiles.open(
+            self.part_path, mode="ab", buffering=0
+        ) as file:
+            async for chunk in archive_chunks:
+                await file.write(chunk)
+                self.size += len(chunk)
+                self.notify()
+        os.replace(self.part_path, self.path)
+
+    async def open(self):
+        try:
+            return await aiofiles.open(self.part_path, mode="rb")
+        except FileNotFoundError:
+            # The build has finished and renamed the file in the meantime
+            return await aiofiles.open(self.path, mode="rb")
+
+    async def read(self, chunk_size):
+        """Yield chunks of the archive as they are written"""
+        file = await self.open()
+        try:
+            offset = 0
+            while True:
+                grown = self.grown
+                if offset < self.size:
+                    chunk = await file.read(min(chunk_size, self.size - offset))
+                    offset += len(chunk)
+                    yield chunk
+                elif self.error:
+                    raise self.error
+                elif self.done:
+                    return
+                else:
+                    await grown.wait()
+        finally:
+            await file.close()
+
+
+class ArchiveCache:
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size  # bytes of all archives in the cache
+        self.archives = OrderedDict()  # {fingerprint: size}, oldest first
+        self.total_size = 0
+        self.builds = {}  # {fingerprint: ArchiveBuild}
+        self.load()
+
+    def get_archive_path(self, fingerprint):
+        return os.path.join(self.path, f"{fingerprint}.zip")
+
+    def load(self):
+        """Pick up archives left by the previous run, drop unfinished ones"""
+        os.makedirs(self.path, exist_ok=True)
+        archives = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(PART_SUFFIX):
+                os.remove(entry.path)
+            elif entry.name.endswith(".zip"):
+                stat = entry.stat()
+                archives.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+
+        for _, fingerprint, size in sorted(archives):
+            self.archives[fingerprint] = size
+            self.total_size += size
+        self.evict()
+
+    def evict(self):
+        while self.total_size > self.max_size and self.archives:
+            fingerprint, size = self.archives.popitem(last=False)
+            self.total_size -= size
+            # Clients reading the archive keep it till they close it
+            os.remove(self.get_archive_path(fingerprint))
+            logging.debug(f"Evicted archive {fingerprint} of {size} bytes")
+
+    async def open(self, fingerprint):
+        """Return opened archive file and its size or None if not cached"""
+        if fingerprint not in self.archives:
+            return None
+        try:
+            file = await aiofiles.open(
+                self.get_archive_path(fingerprint), mode="rb"
+            )
+        except FileNotFoundError:
+            # Evicted while the file was being opened
+            return None
+
+        if fingerprint in self.archives:
+            self.archives.move_to_end(fingerprint)
+        # Archive evicted meanwhile is out of the index, not out of the file
+        return file, os.fstat(file.fileno()).st_size
+
+    async def get_build(self, fingerprint, archive_chunks, admit):
+        """Return the running build of the archive or start a new one.
+
+        A new build waits for admit and holds what it returns, a function
+        releasing the slot, till the end. archive_chunks is called then.
+        Return None if the archive has been cached while waiting.
+        The build goes on when its clients have gone, to cache the archive.
+        """
+        build = self.builds.get(fingerprint)
+        if build is not None:
+            return build
+
+        release = await admit()
+        # Another client could start or finish the build meanwhile
+        build = self.builds.get(fingerprint)
+        if build is not None or fingerprint in self.archives:
+            release()
+            return build
+
+        build = ArchiveBuild(self.get_archive_path(fingerprint))
+        # Created right away, clients open it before the build starts
+        open(build.part_path, "wb").close()
+        self.builds[fingerprint] = build
+        # Loop keeps weak references to tasks, the build keeps its own
+        build.task = asyncio.ensure_future(
+            self.run_build(fingerprint, build, archive_chunks(), release)
+        )
+        return build
+
+    async def run_build(self, fingerprint, build, archive_chunks, release):
+        try:
+            await build.write(archive_chunks)
+        except Exception as error:
+            logging.exception(f"Failed to build archive {fingerprint}")
+            build.error = error
+            if os.path.exists(build.part_path):
+                os.remove(build.part_path)
+        else:
+            self.archives[fingerprint] = build.size
+            self.total_size += build.size
+            self.evict()
+        finally:
+            await archive_chunks.aclose()
+            release()
+            del self.builds[fingerprint]
+            build.done = True
+            build.notify()
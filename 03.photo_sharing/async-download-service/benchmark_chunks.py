@@ -0,0 +1,139 @@
+"""Measure download throughput and peak memory of server at chunk sizes.
+
+Directory of random files named as photos is created in a temporary
+directory, then server.py is started for every engine and chunk size
+and the archive is downloaded once. Peak RSS is taken from the server
+process, 'zip' processes of the zip engine are not counted.
+
+Usage: python3 benchmark_chunks.py [--size_mb 1024] [--chunk_sizes 65536 ...]
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+ARCHIVE_URL = "http://127.0.0.1:8080/archive/benchmark/"
+WRITE_SIZE = 1024 * 1024
+
+
+def create_files(directory, size_mb, files):
+    """Fill the directory with random files, photos don't compress either"""
+    os.makedirs(directory)
+    file_size_mb = size_mb // files
+    for number in range(1, files + 1):
+        with open(os.path.join(directory, f"{number}.jpg"), "wb") as file:
+            for _ in range(file_size_mb):
+                file.write(os.urandom(WRITE_SIZE))
+
+
+def get_peak_rss_mb(pid):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def wait_for_server(timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", 8080)
+        except OSError:
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        return
+    raise RuntimeError("Server hasn't started")
+
+
+async def download(read_size):
+    """Return size of the archive and seconds spent on its download"""
+    started_at = time.monotonic()
+    archive_size = 0
+    async with aiohttp.ClientSession() as session:
+        async with session.get(ARCHIVE_URL) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(read_size):
+                archive_size += len(chunk)
+    return archive_size, time.monotonic() - started_at
+
+
+async def measure(photos_path, engine, chunk_size):
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "server.py",
+            "--path",
+            photos_path,
+            "--engine",
+            engine,
+            "--chunk_size",
+            str(chunk_size),
+            # Every run has to build the archive, not to read the cached one
+            "--cache_size",
+            "0",
+            "--cache_path",
+            os.path.join(photos_path, "cache"),
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        await wait_for_server()
+        archive_size, elapsed = await download(chunk_size)
+        peak_rss_mb = get_peak_rss_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(
+        f"{engine:>6} {chunk_size // 1024:6} KiB: "
+        f"{archive_size / elapsed / 2 ** 20:8.1f} MiB/s, "
+        f"{elapsed:6.2f} s, peak RSS {peak_rss_mb:6.1f} MiB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--size_mb", type=int, default=1024, help="Size of files to archive"
+    )
+    parser.add_argument(
+        "--files", type=int, default=16, help="Amount of files to archive"
+    )
+    parser.add_argument(
+        "--chunk_sizes",
+        type=int,
+        nargs="+",
+        default=[64 * 1024, 256 * 1024, 1024 * 1024],
+        help="Chunk sizes of server to compare, bytes",
+    )
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        default=["python", "zip"],
+        help="Engines of server to compare",
+    )
+    args = parser.parse_args()
+
+    # Server opens index.html and test photos relative to its directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    with tempfile.TemporaryDirectory() as photos_path:
+        create_files(
+            os.path.join(photos_path, "benchmark"), args.size_mb, args.files
+        )
+        for engine in args.engines:
+            for chunk_size in args.chunk_sizes:
+                asyncio.run(measure(photos_path, engine, chunk_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""Fire concurrent downloads at server.py and see how it holds up.
+
+Albums of random photos are made in a temporary directory from a seed,
+so runs with the same arguments download the same archives. A share of
+clients drops the connection after the first chunk to check that their
+'zip' processes are killed. The report has throughput, time to first
+byte, answers by status, 'zip' processes alive after the run and peak
+memory of the server and of its 'zip' processes.
+
+Usage: python3 load_test.py [--concurrency 50] [--downloads 200] ...
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import aiohttp
+
+from benchmark_chunks import get_peak_rss_mb, wait_for_server
+
+SERVER_URL = "http://127.0.0.1:8080"
+SAMPLE_INTERVAL = 0.1  # seconds between looks at 'zip' processes
+
+
+def create_albums(path, albums, photos, photo_size_kb, seed):
+    rng = random.Random(seed)
+    photo_size = photo_size_kb * 1024
+    for album in range(albums):
+        album_path = os.path.join(path, f"album{album}")
+        os.makedirs(album_path)
+        for photo in range(1, photos + 1):
+            with open(os.path.join(album_path, f"{photo}.jpg"), "wb") as file:
+                file.write(
+                    rng.getrandbits(8 * photo_size).to_bytes(
+                        photo_size, "little"
+                    )
+                )
+
+
+def get_zip_processes(server_pid):
+    """Return {pid: (state, rss in MiB)} of 'zip' processes of the server"""
+    zip_processes = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            continue
+        # Name is in parentheses and can have spaces, fields follow it
+        name = stat[stat.index("(") + 1 : stat.rindex(")")]
+        fields = stat[stat.rindex(")") + 2 :].split()
+        state, parent_pid, rss_pages = (
+            fields[0],
+            int(fields[1]),
+            int(fields[21]),
+        )
+        if name == "zip" and parent_pid == server_pid:
+            rss_mb = rss_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+            zip_processes[int(pid)] = (state, rss_mb)
+    return zip_processes
+
+
+class LoadStats:
+    def __init__(self):
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.first_byte_seconds = []
+        self.received_bytes = 0
+        self.disconnects = 0
+        self.peak_zip_processes = 0
+        self.peak_zip_rss_mb = 0.0
+
+
+def get_client_address(number):
+    return f"10.0.{number // 256 % 256}.{number % 256}"
+
+
+async def download(session, url, client, disconnect, read_size, stats):
+    started_at = time.monotonic()
+    # Server queues downloads of every client apart, so clients are faked,
+    # it's started trusting the header
+    headers = {"X-Forwarded-For": client}
+    try:
+        async with session.get(url, headers=headers) as response:
+            stats.statuses[response.status] += 1
+            if response.status != 200:
+                await response.read()
+                return
+            is_first = True
+            async for chunk in response.content.iter_chunked(read_size):
+                if is_first:
+                    stats.first_byte_seconds.append(
+                        time.monotonic() - started_at
+                    )
+                    is_first = False
+                stats.received_bytes += len(chunk)
+                if disconnect:
+                    # Drop the connection, not finish the response politely
+                    response.close()
+                    stats.disconnects += 1
+                    return
+    except aiohttp.ClientError as error:
+        stats.errors[type(error).__name__] += 1
+
+
+async def watch_zip_processes(server_pid, stats):
+    while True:
+        zip_processes = get_zip_processes(server_pid)
+        stats.peak_zip_processes = max(
+            stats.peak_zip_processes, len(zip_processes)
+        )
+        stats.peak_zip_rss_mb = max(
+            stats.peak_zip_rss_mb,
+            sum(rss_mb for _, rss_mb in zip_processes.values()),
+        )
+        await asyncio.sleep(SAMPLE_INTERVAL)
+
+
+async def run_downloads(args, server_pid, stats):
+    rng = random.Random(args.seed)
+    plan = [
+        (
+            f"{SERVER_URL}/archive/album{number % args.albums}/",
+            get_client_address(number % args.clients),
+            rng.random() < args.disconnect_share,
+        )
+        for number in range(args.downloads)
+    ]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_download(url, client, disconnect):
+        async with semaphore:
+            await download(
+                session, url, client, disconnect, args.read_size, stats
+            )
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=None)
+    watcher = asyncio.ensure_future(watch_zip_processes(server_pid, stats))
+    try:
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout
+        ) as session:
+            await asyncio.gather(
+                *[run_download(*download_plan) for download_plan in plan]
+            )
+    finally:
+        watcher.cancel()
+
+
+def get_percentile(values, share):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def print_report(stats, elapsed, left_zip_processes, server_peak_rss_mb):
+    print(f"Downloads by status: {dict(stats.statuses)}")
+    print(f"Errors of clients: {dict(stats.errors)}")
+    print(f"Dropped by client: {stats.disconnects}")
+    print(
+        f"Received {stats.received_bytes / 2 ** 20:.1f} MiB "
+        f"in {elapsed:.2f} s, {stats.received_bytes / elapsed / 2 ** 20:.1f} "
+        "MiB/s"
+    )
+    first_byte_seconds = stats.first_byte_seconds
+    print(
+        "Time to first byte: "
+        f"p50 {get_percentile(first_byte_seconds, 0.5) * 1000:.0f} ms, "
+        f"p95 {get_percentile(first_byte_seconds, 0.95) * 1000:.0f} ms, "
+        f"max {max(first_byte_seconds, default=0) * 1000:.0f} ms"
+    )
+    print(
+        f"'zip' processes: {stats.peak_zip_processes} at once at most, "
+        f"{len(left_zip_processes)} left after the run "
+        f"{sorted(state for state, _ in left_zip_processes.values())}"
+    )
+    print(
+        f"Peak RSS: server {server_peak_rss_mb:.1f} MiB, "
+        f"'zip' processes {stats.peak_zip_rss_mb:.1f} MiB together"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--albums", type=int, default=10, help="Albums to create"
+    )
+    parser.add_argument(
+        "--photos", type=int, default=20, help="Photos in an album"
+    )
+    parser.add_argument(
+        "--photo_size_kb", type=int, default=512, help="Size of a photo"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=1, help="Seed of photos and of disconnects"
+    )
+    parser.add_argument(
+        "--downloads", type=int, default=200, help="Downloads to make"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=50, help="Downloads made at once"
+    )
+    parser.add_argument(
+        "--clients",
+        type=int,
+        default=50,
+        help="Addresses downloads come from, in turn",
+    )
+    parser.add_argument(
+        "--disconnect_share",
+        type=float,
+        default=0.2,
+        help="Share of clients dropping connection after the first chunk",
+    )
+    parser.add_argument(
+        "--read_size",
+        type=int,
+        default=64 * 1024,
+        help="Bytes read by a client at once",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=2,
+        help="Seconds given to server to finish builds before 'zip' "
+        "processes are counted",
+    )
+    parser.add_argument(
+        "--server_args",
+        default="--engine zip --cache_size 0",
+        help="Arguments of server.py, quoted",
+    )
+    args = parser.parse_args()
+
+    # Server opens index.html relative to its directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    with tempfile.TemporaryDirectory() as temp_path:
+        photos_path = os.path.join(temp_path, "photos")
+        create_albums(
+            photos_path, args.albums, args.photos, args.photo_size_kb, args.seed
+        )
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "server.py",
+                "--path",
+                photos_path,
+                "--cache_path",
+                os.path.join(temp_path, "cache"),
+                "--trust_forwarded_for",
+                *shlex.split(args.server_args),
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            asyncio.run(wait_for_server())
+            stats = LoadStats()
+            started_at = time.monotonic()
+            asyncio.run(run_downloads(args, server.pid, stats))
+            elapsed = time.monotonic() - started_at
+
+            time.sleep(args.settle)
+            left_zip_processes = get_zip_processes(server.pid)
+            server_peak_rss_mb = get_peak_rss_mb(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+
+    print_report(stats, elapsed, left_zip_processes, server_peak_rss_mb)
+
+
+if __name__ == "__main__":
+    main()
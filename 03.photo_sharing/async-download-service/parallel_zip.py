@@ -0,0 +1,214 @@
+"""Build ZIP archive compressing files on a pool of processes.
+
+Files are cut into segments, each one is deflated by a worker as a part
+of a single deflate stream: it's primed with the 32 KiB of the file before
+it and ends with a sync flush instead of the end of the stream, the last
+one excepted. Segments are written into the archive in order while the
+next ones are being compressed, so a big album is compressed by all cores
+and still sent as it's built.
+
+Files that don't get smaller, by extension or by a sample of their
+content, are stored as they are.
+"""
+
+import asyncio
+import os
+import signal
+import struct
+import zipfile
+import zlib
+from collections import deque
+
+from zip_stream import (
+    CHUNK_SIZE,
+    STORED_EXTENSIONS,
+    ChunkSink,
+    list_files,
+    write_file,
+)
+
+SEGMENT_SIZE = 1024 * 1024  # bytes of a file compressed by a worker at once
+WINDOW_SIZE = 32 * 1024  # deflate looks back that far for repeats
+SAMPLE_SIZE = 64 * 1024  # bytes compressed to see if a file is compressible
+# Sample compressed to more than this share is stored as is
+MIN_COMPRESSION_RATIO = 0.95
+DATA_DESCRIPTOR_SIGNATURE = 0x08074B50
+USE_DATA_DESCRIPTOR = 0x08
+
+
+def ignore_interrupt():
+    """Leave Ctrl+C to the server, it shuts down the workers itself"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def is_compressible(file_path):
+    """Deflate the beginning of the file quickly and check what it saves"""
+    with open(file_path, "rb") as file:
+        sample = file.read(SAMPLE_SIZE)
+    if not sample:
+        return True
+    compressor = zlib.compressobj(1, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed_size = len(compressor.compress(sample) + compressor.flush())
+    return compressed_size < len(sample) * MIN_COMPRESSION_RATIO
+
+
+def compress_segment(file_path, offset, size, is_last):
+    """Return raw deflate of the segment of the file and CRC-32 of it"""
+    with open(file_path, "rb") as file:
+        window_start = max(0, offset - WINDOW_SIZE)
+        file.seek(window_start)
+        window = file.read(offset - window_start)
+        data = file.read(size)
+
+    options = {"zdict": window} if window else {}
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS, **options
+    )
+    compressed = compressor.compress(data)
+    compressed += compressor.flush(
+        zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH
+    )
+    return compressed, zlib.crc32(data)
+
+
+def combine_crc32(crc, next_crc, next_size):
+    """Return CRC-32 of joined data by CRC-32 of its parts.
+
+    CRC-32 is affine in the initial value, so the difference the first
+    part makes is the same for the second part and for zeros of its size.
+    """
+    zeros = bytes(next_size)
+    return zlib.crc32(zeros, crc) ^ next_crc ^ zlib.crc32(zeros)
+
+
+def get_segments(file_path, file_size):
+    """Return arguments of compress_segment for all segments of the file"""
+    offsets = range(0, max(file_size, 1), SEGMENT_SIZE)
+    return [
+        (
+            file_path,
+            offset,
+            min(SEGMENT_SIZE, file_size - offset),
+            offset + SEGMENT_SIZE >= file_size,
+        )
+        for offset in offsets
+    ]
+
+
+def start_entry(archive, zip_info):
+    """Write local header of a deflated file with sizes following the data.
+
+    That's what zipfile does for a file opened to write into a stream.
+    """
+    zip_info.compress_type = zipfile.ZIP_DEFLATED
+    zip_info.flag_bits = USE_DATA_DESCRIPTOR
+    if not zip_info.external_attr:
+        zip_info.external_attr = 0o600 << 16
+    zip_info.header_offset = archive.fp.tell()
+    # Compressed size can be larger than uncompressed size
+    zip64 = zip_info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    archive.fp.write(zip_info.FileHeader(zip64))
+    return zip64
+
+
+def finish_entry(archive, zip_info, zip64, crc, compress_size):
+    zip_info.CRC = crc
+    zip_info.compress_size = compress_size
+    descriptor_format = "<LLQQ" if zip64 else "<LLLL"
+    archive.fp.write(
+        struct.pack(
+            descriptor_format,
+            DATA_DESCRIPTOR_SIGNATURE,
+            crc,
+            compress_size,
+            zip_info.file_size,
+        )
+    )
+    archive.start_dir = archive.fp.tell()
+    archive.filelist.append(zip_info)
+    archive.NameToInfo[zip_info.filename] = zip_info
+
+
+async def stream_zip_parallel(path, executor, workers, chunk_size=CHUNK_SIZE):
+    """Yield chunks of ZIP archive of the directory, compressed by executor.
+
+    Segments are compressed ahead of the one being sent, twice as many
+    as there are workers, so the workers aren't idle while it's sent.
+    """
+    loop = asyncio.get_event_loop()
+    file_paths = await loop.run_in_executor(None, list_files, path)
+
+    stored_paths = set()
+    unknown_paths = []
+    for file_path in file_paths:
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension in STORED_EXTENSIONS:
+            stored_paths.add(file_path)
+        else:
+            unknown_paths.append(file_path)
+    compressible = await asyncio.gather(
+        *[
+            loop.run_in_executor(executor, is_compressible, file_path)
+            for file_path in unknown_paths
+        ]
+    )
+    stored_paths.update(
+        file_path
+        for file_path, is_deflated in zip(unknown_paths, compressible)
+        if not is_deflated
+    )
+
+    zip_infos = [
+        zipfile.ZipInfo.from_file(file_path) for file_path in file_paths
+    ]
+    segments = iter(
+        [
+            segment
+            for zip_info, file_path in zip(zip_infos, file_paths)
+            if file_path not in stored_paths
+            for segment in get_segments(file_path, zip_info.file_size)
+        ]
+    )
+    max_pending = 2 * workers
+    pending = deque()
+
+    def submit_segments():
+        while len(pending) < max_pending:
+            segment = next(segments, None)
+            if segment is None:
+                break
+            pending.append(
+                loop.run_in_executor(executor, compress_segment, *segment)
+            )
+
+    sink = ChunkSink()
+    archive = zipfile.ZipFile(sink, mode="w")
+    try:
+        for zip_info, file_path in zip(zip_infos, file_paths):
+            if file_path in stored_paths:
+                submit_segments()
+                zip_info.compress_type = zipfile.ZIP_STORED
+                async for chunk in write_file(
+                    archive, sink, zip_info, file_path, chunk_size
+                ):
+                    yield chunk
+                continue
+
+            zip64 = start_entry(archive, zip_info)
+            crc = compress_size = 0
+            for _, _, size, _ in get_segments(file_path, zip_info.file_size):
+                submit_segments()
+                compressed, segment_crc = await pending.popleft()
+                archive.fp.write(compressed)
+                crc = combine_crc32(crc, segment_crc, size)
+                compress_size += len(compressed)
+                if sink.size >= chunk_size:
+                    yield sink.pop()
+            finish_entry(archive, zip_info, zip64, crc, compress_size)
+
+        archive.close()
+        yield sink.pop()
+    finally:
+        # Segments nobody is going to send aren't compressed, if not started
+        for future in pending:
+            future.cancel()
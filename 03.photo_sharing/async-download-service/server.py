@@ -1,67 +1,264 @@
 import argparse
 import asyncio
 import logging
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 
 import aiofiles
 from aiohttp import web
 
+from admission import AdmissionController, QueueFullError
+from archive_cache import ArchiveCache, get_fingerprint
+from parallel_zip import ignore_interrupt, stream_zip_parallel
+from shaping import BandwidthShaper, throttle
+from zip_stream import CHUNK_SIZE, stream_zip
 
-async def archivate(photos_path, delay, request):
-    """Asynchronously archive directory on the fly and send it to client"""
+ENGINES = ["python", "zip", "parallel"]
+CACHE_SIZE = 1024  # megabytes of archives kept on disk
+MAX_BUILDS = 4  # archives built at once
+MAX_QUEUE = 100  # downloads waiting for a build at most
+MAX_CLIENT_QUEUE = 10  # downloads of one client waiting at most
 
-    archive_hash = request.match_info["archive_hash"]
-    path_to_photos = f"{photos_path}/{archive_hash}"
 
-    if not os.path.exists(path_to_photos):
-        logging.debug("Attempt to request non existing archive")
-        return web.HTTPNotFound(
-            text="Archive does not exist or has been removed"
+async def stream_zip_process(path, chunk_size=CHUNK_SIZE):
+    """Yield chunks of archive made by 'zip' utility in a separate process.
+
+    Access times and owners of files aren't saved with -X, so an archive
+    built again has the same bytes and ETag is still true for ranges.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        "zip",
+        "-X",
+        "-r",
+        "-",
+        path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    logging.debug(f"Started: zip -X -r - {path} (pid = {proc.pid})")
+
+    try:
+        while True:
+            # Pipe gives data by pieces of its buffer, they are joined here
+            try:
+                yield await proc.stdout.readexactly(chunk_size)
+            except asyncio.IncompleteReadError as error:
+                if error.partial:
+                    yield error.partial
+                break
+
+        await proc.wait()
+        logging.debug(f"[zip exited with {proc.returncode}]")
+    finally:
+        if proc.returncode is None:
+            logging.debug(f'Killing "zip" process (pid = {proc.pid})')
+            proc.kill()
+            await proc.wait()
+
+
+def get_archive_chunks(app, path_to_photos, engine, chunk_size):
+    if engine == "zip":
+        return stream_zip_process(path_to_photos, chunk_size)
+    if engine == "parallel":
+        return stream_zip_parallel(
+            path_to_photos, app["executor"], app["workers"], chunk_size
         )
+    return stream_zip(path_to_photos, chunk_size)
 
-    command = f"zip -r - {path_to_photos}"
 
-    proc = await asyncio.create_subprocess_shell(
-        command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-    )
-    message = f"Started: {command} (pid = {str(proc.pid)})"
-    logging.debug(message)
+async def read_file(file, start, stop, chunk_size):
+    """Yield chunks of the opened file from start to stop and close it"""
+    try:
+        await file.seek(start)
+        left = stop - start
+        while left > 0:
+            chunk = await file.read(min(chunk_size, left))
+            if not chunk:
+                break
+            left -= len(chunk)
+            yield chunk
+    finally:
+        await file.close()
 
-    response = web.StreamResponse(
-        headers={
-            "Content-Type": "application/zip",
-            "Content-Disposition": 'attachment; filename="archive.zip"',
-        }
+
+def get_byte_range(request, size, etag):
+    """Return (start, stop) of the archive asked by Range, None for whole"""
+    if_range = request.headers.get("If-Range")
+    if if_range is not None and if_range != etag:
+        # Part of another version of the archive is on the client
+        return None
+    try:
+        byte_range = request.http_range
+    except ValueError:
+        # Malformed and multiple ranges are answered with the whole archive
+        return None
+    if byte_range.start is None:
+        return None
+
+    start = byte_range.start
+    if start < 0:
+        start = max(size + start, 0)
+    stop = size if byte_range.stop is None else min(byte_range.stop, size)
+    if start >= size:
+        raise web.HTTPRequestRangeNotSatisfiable(
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, stop
+
+
+def get_client(request):
+    """Return address of the client.
+
+    X-Forwarded-For is set by anyone, so its first address is taken only
+    if the server is told it stands behind a proxy setting the header.
+    """
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if forwarded_for and request.app["trust_forwarded_for"]:
+        return forwarded_for.split(",")[0].strip()
+    return request.remote
+
+
+def get_busy_response(error):
+    logging.debug(f"Download is rejected: {error}")
+    return web.HTTPServiceUnavailable(
+        headers={"Retry-After": str(error.retry_after)},
+        text="Too many downloads at the moment, please try again later",
     )
+
+
+async def send_archive(request, response, archive_chunks, shaper):
+    """Send chunks to the client, stop quietly if it has gone"""
+    # Said in headers, or the client reuses the connection closed after it
+    response.force_close()
     # Send HTTP headers to the client
     await response.prepare(request)
+    sent_bytes = sent_chunks = 0
+    buckets = shaper.get_buckets()
 
     try:
-        while True:
-            if delay:
-                await asyncio.sleep(delay)
-            archive_chunk = await proc.stdout.readline()
-            if not archive_chunk:
-                message = f"[{command!r} exited with {proc.returncode}]"
-                logging.debug(message)
-                break
+        async for archive_chunk in archive_chunks:
+            await throttle(buckets, len(archive_chunk))
 
-            logging.debug("Sending archive chunk ...")
+            # Waits while the client is slow, so chunks don't pile up
             await response.write(archive_chunk)
+            sent_bytes += len(archive_chunk)
+            sent_chunks += 1
+
+        logging.debug(f"Sent {sent_bytes} bytes in {sent_chunks} chunks")
 
     except asyncio.CancelledError:
         logging.debug("Seems like client was disconnected")
-        message = f'Killing "zip" process (pid = {str(proc.pid)})'
-        proc.kill()
-        logging.debug(message)
         raise
+    except ConnectionResetError:
+        # Newer aiohttp reports the disconnection on write instead of cancel
+        logging.debug("Seems like client was disconnected")
     finally:
-        response.force_close()
+        # Files are closed and 'zip' is killed right away, not by GC
+        await archive_chunks.aclose()
 
     return response
 
 
+async def archivate(
+    photos_path, engine, chunk_size, cache, admission, shaper, request
+):
+    """Asynchronously archive directory on the fly and send it to client"""
+
+    archive_hash = request.match_info["archive_hash"]
+    path_to_photos = f"{photos_path}/{archive_hash}"
+
+    if not os.path.exists(path_to_photos):
+        logging.debug("Attempt to request non existing archive")
+        return web.HTTPNotFound(
+            text="Archive does not exist or has been removed"
+        )
+
+    headers = {
+        "Content-Type": "application/zip",
+        "Content-Disposition": 'attachment; filename="archive.zip"',
+    }
+    if cache is None:
+        try:
+            release = await admission.acquire(get_client(request))
+        except QueueFullError as error:
+            return get_busy_response(error)
+        archive_chunks = get_archive_chunks(
+            request.app, path_to_photos, engine, chunk_size
+        )
+        response = web.StreamResponse(headers=headers)
+        try:
+            return await send_archive(request, response, archive_chunks, shaper)
+        finally:
+            release()
+
+    loop = asyncio.get_event_loop()
+    # Archives of the engines differ, so the engine is a part of the key
+    fingerprint = await loop.run_in_executor(
+        None, get_fingerprint, path_to_photos, engine
+    )
+    etag = f'"{fingerprint}"'
+    if etag in request.headers.get("If-None-Match", ""):
+        return web.HTTPNotModified(headers={"ETag": etag})
+    headers["ETag"] = etag
+
+    while True:
+        cached = await cache.open(fingerprint)
+        if cached is not None:
+            break
+        try:
+            build = await cache.get_build(
+                fingerprint,
+                partial(
+                    get_archive_chunks,
+                    request.app,
+                    path_to_photos,
+                    engine,
+                    chunk_size,
+                ),
+                partial(admission.acquire, get_client(request)),
+            )
+        except QueueFullError as error:
+            return get_busy_response(error)
+        if build is not None:
+            # Size is unknown till the build ends, Range is served when cached
+            response = web.StreamResponse(headers=headers)
+            archive_chunks = build.read(chunk_size)
+            return await send_archive(request, response, archive_chunks, shaper)
+
+    file, size = cached
+    try:
+        byte_range = get_byte_range(request, size, etag)
+    except web.HTTPRequestRangeNotSatisfiable:
+        await file.close()
+        raise
+
+    headers["Accept-Ranges"] = "bytes"
+    response = web.StreamResponse(headers=headers)
+    if byte_range is None:
+        start, stop = 0, size
+    else:
+        start, stop = byte_range
+        response.set_status(206)
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    response.content_length = stop - start
+
+    archive_chunks = read_file(file, start, stop, chunk_size)
+    return await send_archive(request, response, archive_chunks, shaper)
+
+
+async def handle_metrics(admission, request):
+    return web.Response(
+        text=admission.render_metrics(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def shutdown_executor(app):
+    app["executor"].shutdown(wait=False)
+
+
 async def handle_index_page(request):
     async with aiofiles.open("index.html", mode="r") as index_file:
         index_contents = await index_file.read()
@@ -73,9 +270,62 @@ def main():
     parser.add_argument("--path", type=str, help="Set directory for photos")
     parser.add_argument("--debug", action="store_true", help="Set debug mode")
     parser.add_argument(
-        "--delay",
-        type=float,
-        help="Set delay between sending chunks in seconds",
+        "--rate_limit",
+        type=int,
+        help="Set bytes per second sent to one client, unlimited by default",
+    )
+    parser.add_argument(
+        "--total_rate_limit",
+        type=int,
+        help="Set bytes per second sent to all clients, unlimited by default",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        help="Set bytes to read and send at once, 64 KiB by default",
+    )
+    parser.add_argument(
+        "--cache_path", type=str, help="Set directory for built archives"
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        help=f"Set megabytes of archives to keep, {CACHE_SIZE} by default, "
+        "0 to build every archive again",
+    )
+    parser.add_argument(
+        "--max_builds",
+        type=int,
+        help=f"Set archives built at once, {MAX_BUILDS} by default",
+    )
+    parser.add_argument(
+        "--max_queue",
+        type=int,
+        help=f"Set downloads waiting for a build, {MAX_QUEUE} by default",
+    )
+    parser.add_argument(
+        "--max_client_queue",
+        type=int,
+        help="Set downloads of one client waiting for a build, "
+        f"{MAX_CLIENT_QUEUE} by default",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        help="Build archives in process, by 'zip' utility or by processes "
+        "compressing files in parallel",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Set processes compressing files for parallel engine, "
+        "number of CPUs by default",
+    )
+    parser.add_argument(
+        "--trust_forwarded_for",
+        action="store_true",
+        help="Find clients by X-Forwarded-For, set only behind a proxy "
+        "setting it",
     )
     args = parser.parse_args()
 
@@ -83,16 +333,66 @@ def main():
         logging.basicConfig(level=logging.DEBUG)
 
     photos_path = args.path or os.getenv("PHOTOS_PATH", "test_photos")
-    delay = args.delay or float(os.getenv("DELAY", "0"))
+    rate_limit = args.rate_limit or int(os.getenv("RATE_LIMIT", "0"))
+    total_rate_limit = args.total_rate_limit or int(
+        os.getenv("TOTAL_RATE_LIMIT", "0")
+    )
+    shaper = BandwidthShaper(rate_limit, total_rate_limit)
+    engine = args.engine or os.getenv("ENGINE", "python")
+    chunk_size = args.chunk_size or int(os.getenv("CHUNK_SIZE", CHUNK_SIZE))
+    cache_path = args.cache_path or os.getenv("CACHE_PATH", "archive_cache")
+    if args.cache_size is None:
+        cache_size = int(os.getenv("CACHE_SIZE", CACHE_SIZE))
+    else:
+        cache_size = args.cache_size
+
+    max_builds = args.max_builds or int(os.getenv("MAX_BUILDS", MAX_BUILDS))
+    if args.max_queue is None:
+        max_queue = int(os.getenv("MAX_QUEUE", MAX_QUEUE))
+    else:
+        max_queue = args.max_queue
+    if args.max_client_queue is None:
+        max_client_queue = int(os.getenv("MAX_CLIENT_QUEUE", MAX_CLIENT_QUEUE))
+    else:
+        max_client_queue = args.max_client_queue
+    admission = AdmissionController(max_builds, max_queue, max_client_queue)
+
+    cache = None
+    if cache_size:
+        cache = ArchiveCache(cache_path, cache_size * 1024 * 1024)
 
     app = web.Application()
+    app["trust_forwarded_for"] = (
+        args.trust_forwarded_for or os.getenv("TRUST_FORWARDED_FOR") == "1"
+    )
+    if engine == "parallel":
+        app["workers"] = args.workers or int(
+            os.getenv("WORKERS", os.cpu_count())
+        )
+        # Workers are started from the running event loop, forked ones would
+        # get a copy of it with the sockets of all connections
+        app["executor"] = ProcessPoolExecutor(
+            app["workers"],
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=ignore_interrupt,
+        )
+        app.on_cleanup.append(shutdown_executor)
     app.add_routes(
         [
             web.get("/", handle_index_page),
             web.get(
                 "/archive/{archive_hash}/",
-                partial(archivate, photos_path, delay),
+                partial(
+                    archivate,
+                    photos_path,
+                    engine,
+                    chunk_size,
+                    cache,
+                    admission,
+                    shaper,
+                ),
             ),
+            web.get("/metrics", partial(handle_metrics, admission)),
         ]
     )
     web.run_app(app)
@@ -0,0 +1,52 @@
+"""Limit bytes per second sent to one client and to all of them.
+
+Bytes are taken from token buckets before they are written. A bucket can
+go into debt: the writer takes its bytes at once and sleeps till the debt
+is paid. Writers are paid off in the order they came, so under the total
+limit every download gets its chunks in turn and none is starved.
+"""
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate  # bytes per second
+        self.burst = burst or rate  # bytes sent at once after a pause
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+
+    def reserve(self, amount):
+        """Take amount of bytes, return seconds to wait till they're paid"""
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+        self.tokens -= amount
+        return max(0, -self.tokens / self.rate)
+
+
+class BandwidthShaper:
+    def __init__(self, connection_rate, total_rate):
+        self.connection_rate = connection_rate
+        self.total_bucket = None
+        if total_rate:
+            self.total_bucket = TokenBucket(total_rate)
+
+    def get_buckets(self):
+        """Return buckets of a new connection, no buckets if unlimited"""
+        buckets = []
+        if self.connection_rate:
+            buckets.append(TokenBucket(self.connection_rate))
+        if self.total_bucket:
+            buckets.append(self.total_bucket)
+        return buckets
+
+
+async def throttle(buckets, amount):
+    """Wait till amount of bytes can be sent within limits of all buckets"""
+    delay = max((bucket.reserve(amount) for bucket in buckets), default=0)
+    if delay:
+        await asyncio.sleep(delay)
@@ -0,0 +1,93 @@
+"""Build ZIP archive in process and give it away chunk by chunk.
+
+zipfile writes into a sink that can't seek, so sizes and checksums of
+files follow their data, and the archive is sent while it is being built.
+Only a chunk of a file and the headers around it are in memory at once.
+"""
+
+import asyncio
+import os
+import zipfile
+
+import aiofiles
+
+CHUNK_SIZE = 64 * 1024  # bytes read from a file and sent to client at once
+# Files compressed already are stored as is, deflating them is a waste of CPU
+STORED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".zip", ".gz"}
+
+
+class ChunkSink:
+    """Write-only file collecting what zipfile writes till it's taken"""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def list_files(path):
+    """Return paths of all files inside the directory, sorted"""
+    return sorted(
+        os.path.join(directory, filename)
+        for directory, _, filenames in os.walk(path)
+        for filename in filenames
+    )
+
+
+def get_compress_type(file_path):
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+async def write_file(archive, sink, zip_info, file_path, chunk_size):
+    """Write the file into the archive, yield chunks of it on the way"""
+    async with aiofiles.open(file_path, mode="rb") as file:
+        with archive.open(zip_info, mode="w") as archive_file:
+            while True:
+                chunk = await file.read(chunk_size)
+                if not chunk:
+                    break
+                archive_file.write(chunk)
+                if sink.size >= chunk_size:
+                    yield sink.pop()
+
+
+async def stream_zip(path, chunk_size=CHUNK_SIZE):
+    """Yield chunks of ZIP archive of the directory.
+
+    Headers and small pieces of compressed data are joined with file data,
+    so every chunk but the last one is chunk_size bytes at least.
+    Files are named in the archive by their paths, like 'zip -r' does.
+    """
+    loop = asyncio.get_event_loop()
+    file_paths = await loop.run_in_executor(None, list_files, path)
+
+    sink = ChunkSink()
+    archive = zipfile.ZipFile(sink, mode="w")
+    for file_path in file_paths:
+        # Known size lets zipfile decide on ZIP64 before the data is written
+        zip_info = zipfile.ZipInfo.from_file(file_path)
+        zip_info.compress_type = get_compress_type(file_path)
+
+        async for chunk in write_file(
+            archive, sink, zip_info, file_path, chunk_size
+        ):
+            yield chunk
+
+    archive.close()
+    yield sink.pop()
@@ -0,0 +1,106 @@
+"""Compare bounds queries over a plain dict of buses and over BusGrid.
+
+Usage: python3 benchmark_grid.py [--fleet 10000 100000] [--repeat 20]
+"""
+
+import argparse
+import random
+import timeit
+
+from models import Bus, WindowBounds
+from storage import BusGrid
+
+# Approximate Moscow area, where all routes are located
+SOUTH_LAT, NORTH_LAT = 55.55, 55.95
+WEST_LNG, EAST_LNG = 37.35, 37.85
+
+# Window of index.html with default zoom level (14) and HD screen
+WINDOW_HEIGHT, WINDOW_WIDTH = 0.05, 0.1
+
+
+def generate_buses(amount):
+    return [
+        Bus(
+            busId=f"bus-{index}",
+            route=str(index % 600),
+            lat=random.uniform(SOUTH_LAT, NORTH_LAT),
+            lng=random.uniform(WEST_LNG, EAST_LNG),
+        )
+        for index in range(amount)
+    ]
+
+
+def generate_bounds():
+    south_lat = random.uniform(SOUTH_LAT, NORTH_LAT - WINDOW_HEIGHT)
+    west_lng = random.uniform(WEST_LNG, EAST_LNG - WINDOW_WIDTH)
+    return WindowBounds(
+        south_lat=south_lat,
+        north_lat=south_lat + WINDOW_HEIGHT,
+        west_lng=west_lng,
+        east_lng=west_lng + WINDOW_WIDTH,
+    )
+
+
+def scan_dict(buses, bounds):
+    return [
+        bus_info
+        for _, bus_info in buses.items()
+        if bounds.is_inside(bus_info.lat, bus_info.lng)
+    ]
+
+
+def run(fleet_size, repeat):
+    all_buses = generate_buses(fleet_size)
+    bounds_list = [generate_bounds() for _ in range(repeat)]
+
+    buses = {bus.busId: bus for bus in all_buses}
+    grid = BusGrid()
+    for bus in all_buses:
+        grid.update(bus)
+
+    for bounds in bounds_list:
+        expected = sorted(bus.busId for bus in scan_dict(buses, bounds))
+        found = sorted(bus.busId for bus in grid.get_buses_inside(bounds))
+        assert expected == found, "BusGrid result differs from full scan"
+
+    dict_time = timeit.timeit(
+        lambda: [scan_dict(buses, bounds) for bounds in bounds_list], number=1
+    )
+    grid_time = timeit.timeit(
+        lambda: [grid.get_buses_inside(bounds) for bounds in bounds_list],
+        number=1,
+    )
+
+    moved_buses = generate_buses(fleet_size)
+    update_time = timeit.timeit(
+        lambda: [grid.update(bus) for bus in moved_buses], number=1
+    )
+
+    print(f"Fleet of {fleet_size} buses, {repeat} queries:")
+    print(f"  dict scan:   {dict_time / repeat * 1000:8.3f} ms per query")
+    print(f"  grid lookup: {grid_time / repeat * 1000:8.3f} ms per query")
+    print(f"  speedup:     {dict_time / grid_time:8.1f}x")
+    print(f"  grid update: {update_time / fleet_size * 1e6:8.3f} us per bus")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--fleet",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000],
+        help="Amount of buses to compare on",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=20, help="Amount of bounds queries"
+    )
+    args = parser.parse_args()
+
+    random.seed(0)
+    for fleet_size in args.fleet:
+        run(fleet_size, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+"""Measure throughput and latency of server.py on localhost.
+
+The server is started in a separate process with counters attached to its
+hot paths. This process drives it with a simulator load and a number of
+synthetic browsers, then reports ingest rate, end-to-end latency from
+a simulator send to a browser receive and CPU spent on broadcast per tick.
+
+Usage: python3 benchmark_server.py --buses 10000 --browsers 20 --duration 10
+"""
+
+import contextlib
+import json
+import multiprocessing
+import queue
+import random
+import statistics
+import time
+from dataclasses import dataclass, field, replace
+
+import asyncclick as click
+import trio
+from trio_websocket import open_websocket_url, serve_websocket, HandshakeError
+
+import broadcast
+import server
+
+HOST = "127.0.0.1"
+REPORT_INTERVAL = 1  # seconds between server stats reports
+PROBES_AMOUNT = 100  # buses whose positions are tracked for latency
+
+# Approximate Moscow area, where all routes are located
+SOUTH_LAT, NORTH_LAT = 55.55, 55.95
+WEST_LNG, EAST_LNG = 37.35, 37.85
+
+
+@dataclass
+class ServerStats:
+    ingested: int = 0  # bus positions stored by handle_simulator
+    tick_cpu: float = 0.0  # CPU seconds spent on broadcast in current tick
+    ticks_cpu: list = field(default_factory=list)
+
+
+def measure_cpu(function, stats):
+    def wrapper(*args, **kwargs):
+        started_at = time.thread_time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats.tick_cpu += time.thread_time() - started_at
+
+    return wrapper
+
+
+def instrument_server(stats):
+    """Attach counters to the hot paths of server module"""
+    store_bus = server.buses.update
+
+    def update(bus):
+        stats.ingested += 1
+        store_bus(bus)
+
+    server.buses.update = update
+
+    # Snapshot refresh starts a new tick: close CPU counter of previous one
+    refresh = measure_cpu(server.broadcaster.refresh, stats)
+
+    def refresh_tick():
+        stats.ticks_cpu.append(stats.tick_cpu)
+        stats.tick_cpu = 0.0
+        refresh()
+
+    server.broadcaster.refresh = refresh_tick
+    broadcast.BrowserFeed.get_message = measure_cpu(
+        broadcast.BrowserFeed.get_message, stats
+    )
+
+
+async def serve(simulator_port, browser_port, storage, stats_queue):
+    server.use_storage(storage)
+    stats = ServerStats()
+    instrument_server(stats)
+    server.logger.disabled = True
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(server.broadcaster.run)
+        nursery.start_soon(
+            serve_websocket, server.handle_simulator, HOST, simulator_port, None
+        )
+        nursery.start_soon(
+            serve_websocket, server.handle_browser, HOST, browser_port, None
+        )
+
+        while True:
+            await trio.sleep(REPORT_INTERVAL)
+            ticks_cpu, stats.ticks_cpu = stats.ticks_cpu, []
+            stats_queue.put((time.monotonic(), stats.ingested, ticks_cpu))
+
+
+def run_server(simulator_port, browser_port, storage, stats_queue):
+    with contextlib.suppress(KeyboardInterrupt):
+        trio.run(serve, simulator_port, browser_port, storage, stats_queue)
+
+
+@dataclass
+class LoadStats:
+    sent: int = 0
+    # {(bus_id, lat): send time} of probe buses positions
+    probe_sent_at: dict = field(default_factory=dict)
+    latencies: list = field(default_factory=list)
+    frames: int = 0
+    frames_bytes: int = 0
+
+
+async def wait_for_server(url):
+    while True:
+        try:
+            async with open_websocket_url(url):
+                return
+        except (OSError, HandshakeError):
+            await trio.sleep(0.1)
+
+
+def move_bus(bus):
+    bus["lat"] = min(
+        max(bus["lat"] + random.uniform(-1e-3, 1e-3), SOUTH_LAT), NORTH_LAT
+    )
+    bus["lng"] = min(
+        max(bus["lng"] + random.uniform(-1e-3, 1e-3), WEST_LNG), EAST_LNG
+    )
+
+
+async def drive_simulator(url, buses, refresh_timeout, stats):
+    """Send positions of all buses as one batch every refresh timeout"""
+    async with open_websocket_url(url) as ws:
+        while True:
+            for bus in buses:
+                move_bus(bus)
+                if bus["probe"]:
+                    key = bus["busId"], bus["lat"]
+                    stats.probe_sent_at[key] = time.monotonic()
+
+            batch = [
+                {key: bus[key] for key in ("busId", "route", "lat", "lng")}
+                for bus in buses
+            ]
+            await ws.send_message(json.dumps(batch))
+            stats.sent += len(batch)
+            await trio.sleep(refresh_timeout)
+
+
+def generate_bounds(window_size):
+    south_lat = random.uniform(SOUTH_LAT, NORTH_LAT - window_size)
+    west_lng = random.uniform(WEST_LNG, EAST_LNG - window_size * 2)
+    return {
+        "south_lat": south_lat,
+        "north_lat": south_lat + window_size,
+        "west_lng": west_lng,
+        "east_lng": west_lng + window_size * 2,
+    }
+
+
+async def drive_browser(url, window_size, stats):
+    async with open_websocket_url(url) as ws:
+        bounds = generate_bounds(window_size)
+        await ws.send_message(
+            json.dumps({"msgType": "newBounds", "data": bounds})
+        )
+
+        while True:
+            message = await ws.get_message()
+            received_at = time.monotonic()
+            stats.frames += 1
+            stats.frames_bytes += len(message)
+
+            frame = json.loads(message)
+            buses = frame.get("buses", []) + frame.get("added", [])
+            buses += frame.get("moved", [])
+            for bus in buses:
+                sent_at = stats.probe_sent_at.get((bus["busId"], bus["lat"]))
+                if sent_at is not None:
+                    stats.latencies.append(received_at - sent_at)
+
+
+def percentile(values, percent):
+    if len(values) < 2:
+        return values[0] if values else float("nan")
+    return statistics.quantiles(values, n=100)[percent - 1]
+
+
+def collect_server_stats(stats_queue, started_at, ended_at=float("inf")):
+    reports = []
+    with contextlib.suppress(queue.Empty):
+        while True:
+            reports.append(stats_queue.get_nowait())
+    return [report for report in reports if started_at <= report[0] <= ended_at]
+
+
+def print_report(load_stats, server_reports, duration, browsers):
+    click.echo(
+        f"Sent by simulators:  {load_stats.sent / duration:10.0f} positions/s"
+    )
+
+    if len(server_reports) >= 2:
+        first_time, first_ingested, _ = server_reports[0]
+        last_time, last_ingested, _ = server_reports[-1]
+        ingest_rate = (last_ingested - first_ingested) / (
+            last_time - first_time
+        )
+        click.echo(f"Ingested by server:  {ingest_rate:10.0f} positions/s")
+
+    latencies = [latency * 1000 for latency in load_stats.latencies]
+    click.echo(f"Latency p50:         {percentile(latencies, 50):10.1f} ms")
+    click.echo(f"Latency p99:         {percentile(latencies, 99):10.1f} ms")
+    click.echo(f"Latency samples:     {len(latencies):10d}")
+
+    ticks_cpu = [
+        tick_cpu * 1000
+        for _, _, ticks_cpu in server_reports
+        for tick_cpu in ticks_cpu
+    ]
+    mean_tick_cpu = statistics.fmean(ticks_cpu) if ticks_cpu else float("nan")
+    click.echo(f"Broadcast CPU mean:  {mean_tick_cpu:10.2f} ms/tick")
+    click.echo(
+        f"Broadcast CPU p99:   {percentile(ticks_cpu, 99):10.2f} ms/tick"
+    )
+
+    frames_per_browser = load_stats.frames / duration / browsers
+    click.echo(f"Frames per browser:  {frames_per_browser:10.1f} per second")
+    received_mib = load_stats.frames_bytes / duration / 2**20
+    click.echo(f"Received by browsers:{received_mib:10.2f} MiB/s")
+
+
+@click.command()
+@click.option(
+    "--buses",
+    default=10_000,
+    show_default=True,
+    type=int,
+    help="Amount of simulated buses",
+)
+@click.option(
+    "--websockets_number",
+    default=5,
+    show_default=True,
+    type=int,
+    help="Amount of simulator websockets",
+)
+@click.option(
+    "--browsers",
+    default=20,
+    show_default=True,
+    type=int,
+    help="Amount of synthetic browsers",
+)
+@click.option(
+    "--window_size",
+    default=0.05,
+    show_default=True,
+    type=float,
+    help="Height of browser window in degrees",
+)
+@click.option(
+    "--refresh_timeout",
+    default=0.1,
+    show_default=True,
+    type=float,
+    help="Delay between positions of a bus",
+)
+@click.option(
+    "--duration",
+    default=10,
+    show_default=True,
+    type=float,
+    help="Seconds to measure",
+)
+@click.option(
+    "--warmup",
+    default=2,
+    show_default=True,
+    type=float,
+    help="Seconds to wait before measuring",
+)
+@click.option(
+    "--simulator_port",
+    default=18080,
+    show_default=True,
+    type=int,
+    help="Port of the server for simulators",
+)
+@click.option(
+    "--browser_port",
+    default=18000,
+    show_default=True,
+    type=int,
+    help="Port of the server for browsers",
+)
+@click.option(
+    "--storage",
+    default="grid",
+    show_default=True,
+    type=click.Choice(server.STORAGES),
+    help="Storage of buses in the server",
+)
+async def main(
+    buses,
+    websockets_number,
+    browsers,
+    window_size,
+    refresh_timeout,
+    duration,
+    warmup,
+    simulator_port,
+    browser_port,
+    storage,
+):
+    context = multiprocessing.get_context("spawn")
+    stats_queue = context.Queue()
+    server_process = context.Process(
+        target=run_server,
+        args=(simulator_port, browser_port, storage, stats_queue),
+        daemon=True,
+    )
+    server_process.start()
+
+    simulator_url = f"ws://{HOST}:{simulator_port}"
+    browser_url = f"ws://{HOST}:{browser_port}"
+
+    all_buses = [
+        {
+            "busId": f"bench-{index}",
+            "route": str(index % 600),
+            "lat": random.uniform(SOUTH_LAT, NORTH_LAT),
+            "lng": random.uniform(WEST_LNG, EAST_LNG),
+            "probe": index < PROBES_AMOUNT,
+        }
+        for index in range(buses)
+    ]
+
+    try:
+        await wait_for_server(simulator_url)
+        await wait_for_server(browser_url)
+
+        load_stats = LoadStats()
+        async with trio.open_nursery() as nursery:
+            for index in range(websockets_number):
+                nursery.start_soon(
+                    drive_simulator,
+                    simulator_url,
+                    all_buses[index::websockets_number],
+                    refresh_timeout,
+                    load_stats,
+                )
+            for _ in range(browsers):
+                nursery.start_soon(
+                    drive_browser, browser_url, window_size, load_stats
+                )
+
+            await trio.sleep(warmup)
+            collect_server_stats(stats_queue, time.monotonic())
+            load_stats.sent = load_stats.frames = load_stats.frames_bytes = 0
+            load_stats.latencies.clear()
+
+            started_at = time.monotonic()
+            await trio.sleep(duration)
+            # Load goes on while the last report arrives, rates are taken
+            # for the duration only
+            ended_at = time.monotonic()
+            measured_stats = replace(
+                load_stats, latencies=list(load_stats.latencies)
+            )
+            await trio.sleep(REPORT_INTERVAL)  # let the last report arrive
+            nursery.cancel_scope.cancel()
+
+        server_reports = collect_server_stats(stats_queue, started_at, ended_at)
+        print_report(
+            measured_stats, server_reports, ended_at - started_at, browsers
+        )
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+
+if __name__ == "__main__":
+    with contextlib.suppress(KeyboardInterrupt):
+        main(_anyio_backend="trio")
@@ -0,0 +1,174 @@
+"""Compare bounds queries of all browsers per tick over bus storages.
+
+Every tick server finds buses inside bounds of every connected browser:
+plain dict scans the fleet for every browser, BusGrid walks the cells
+overlapping every bounds and ColumnarBuses compares all bounds with all
+buses in one vectorized operation. Queries alone don't make a tick, so
+the crossover is found by whole ticks of Broadcaster: refresh of moved
+buses and a frame for every browser, built from snapshots and deltas.
+
+Usage: python3 benchmark_storage.py [--fleet 1000 10000 100000] [--browsers 50]
+"""
+
+import argparse
+import random
+import time
+import timeit
+
+from benchmark_grid import generate_bounds, generate_buses, scan_dict
+from broadcast import Broadcaster, BrowserFeed
+from columnar_storage import ColumnarBuses
+from models import Bus
+from storage import BusGrid
+
+MOVE_STEP = 0.001  # degrees a bus moves between ticks at most
+
+
+def measure(function, repeat):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def move_buses(all_buses):
+    """Return positions of all buses after a tick, every bus moves"""
+    return [
+        Bus(
+            bus.busId,
+            bus.route,
+            bus.lat + random.uniform(-MOVE_STEP, MOVE_STEP),
+            bus.lng + random.uniform(-MOVE_STEP, MOVE_STEP),
+        )
+        for bus in all_buses
+    ]
+
+
+def measure_ticks(storage, all_buses, bounds_list, repeat):
+    """Return the best time of refresh and frames of all browsers per tick.
+
+    Buses are moved before every tick, out of the measured time. The first
+    tick serializes all buses and sends full snapshots, it's not counted.
+    """
+    broadcaster = Broadcaster(storage)
+    feeds = [BrowserFeed(broadcaster) for _ in bounds_list]
+    for bounds in bounds_list:
+        broadcaster.watch(bounds)
+
+    tick_times = []
+    for _ in range(repeat + 1):
+        all_buses = move_buses(all_buses)
+        for bus in all_buses:
+            storage.update(bus)
+        started_at = time.perf_counter()
+        broadcaster.refresh()
+        for feed, bounds in zip(feeds, bounds_list):
+            feed.get_message(bounds)
+        tick_times.append(time.perf_counter() - started_at)
+    return min(tick_times[1:])
+
+
+def run(fleet_size, browsers, repeat):
+    all_buses = generate_buses(fleet_size)
+    bounds_list = [generate_bounds() for _ in range(browsers)]
+
+    buses = {bus.busId: bus for bus in all_buses}
+    grid = BusGrid()
+    columns = ColumnarBuses()
+    for bus in all_buses:
+        grid.update(bus)
+        columns.update(bus)
+
+    expected = [
+        sorted(bus.busId for bus in scan_dict(buses, bounds))
+        for bounds in bounds_list
+    ]
+    for storage in (grid, columns):
+        found = storage.get_bus_ids_inside_many(bounds_list)
+        assert expected == [
+            sorted(bus_ids) for bus_ids in found
+        ], f"{type(storage).__name__} result differs from full scan"
+
+    dict_time = measure(
+        lambda: [scan_dict(buses, bounds) for bounds in bounds_list], repeat
+    )
+    grid_time = measure(
+        lambda: grid.get_bus_ids_inside_many(bounds_list), repeat
+    )
+    columnar_time = measure(
+        lambda: columns.get_bus_ids_inside_many(bounds_list), repeat
+    )
+
+    grid_tick_time = measure_ticks(grid, all_buses, bounds_list, repeat)
+    columnar_tick_time = measure_ticks(columns, all_buses, bounds_list, repeat)
+
+    moved_buses = generate_buses(fleet_size)
+    grid_update_time = measure(
+        lambda: [grid.update(bus) for bus in moved_buses], 1
+    )
+    columnar_update_time = measure(
+        lambda: [columns.update(bus) for bus in moved_buses], 1
+    )
+
+    print(f"Fleet of {fleet_size} buses, {browsers} browsers:")
+    print(f"  dict scan:       {dict_time * 1000:8.3f} ms per tick")
+    print(f"  grid lookup:     {grid_time * 1000:8.3f} ms per tick")
+    print(f"  columnar filter: {columnar_time * 1000:8.3f} ms per tick")
+    print(f"  grid tick:       {grid_tick_time * 1000:8.3f} ms per tick")
+    print(f"  columnar tick:   {columnar_tick_time * 1000:8.3f} ms per tick")
+    print(
+        f"  grid update:     "
+        f"{grid_update_time / fleet_size * 1e6:8.3f} us per bus"
+    )
+    print(
+        f"  columnar update: "
+        f"{columnar_update_time / fleet_size * 1e6:8.3f} us per bus"
+    )
+    return grid_tick_time, columnar_tick_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--fleet",
+        type=int,
+        nargs="+",
+        default=[10, 30, 100, 300, 1000, 3000, 10_000, 100_000],
+        help="Amounts of buses to compare on",
+    )
+    parser.add_argument(
+        "--browsers", type=int, default=50, help="Amount of browser bounds"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Ticks to take the best of"
+    )
+    args = parser.parse_args()
+
+    random.seed(0)
+    fleet_sizes = sorted(args.fleet)
+    columnar_wins = []
+    for fleet_size in fleet_sizes:
+        grid_tick_time, columnar_tick_time = run(
+            fleet_size, args.browsers, args.repeat
+        )
+        columnar_wins.append(columnar_tick_time < grid_tick_time)
+
+    # Columnar storage has to keep winning on larger fleets to be chosen
+    crossover = len(fleet_sizes)
+    while crossover and columnar_wins[crossover - 1]:
+        crossover -= 1
+
+    if crossover == len(fleet_sizes):
+        print("Columnar storage hasn't beaten the grid on the largest fleet")
+    elif crossover == 0:
+        # Smaller fleets weren't tried, the grid could lose on them too
+        print(
+            "Columnar storage beats the grid on all fleets, crossover is at "
+            f"or below {fleet_sizes[0]} buses"
+        )
+    else:
+        print(
+            "Columnar storage beats the grid from somewhere between "
+            f"{fleet_sizes[crossover - 1]} and {fleet_sizes[crossover]} buses"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Compare validation of simulator messages by marshmallow and by fast path.
+
+Usage: python3 benchmark_validation.py [--messages 10000] [--batch_size 1000]
+"""
+
+import argparse
+import itertools
+import json
+import timeit
+
+from harmful_bus import ERROR_MESSAGES
+from models import MessageSource
+from schema import BusSchema
+from utils import (
+    generate_bus_id,
+    get_valid_buses,
+    load_routes,
+    validate_message,
+)
+
+
+def validate_by_marshmallow(json_message):
+    """Validation as it was done before the fast path"""
+    message = json.loads(json_message)
+    return BusSchema(many=isinstance(message, list)).validate(data=message)
+
+
+def generate_fake_bus_messages(amount):
+    """Positions in the same shape as fake_bus.py sends them"""
+    messages = []
+    for bus_number in itertools.count(1):
+        for route in load_routes():
+            bus_id = generate_bus_id("", route["name"], bus_number)
+            for latitude, longitude in route["coordinates"]:
+                messages.append(
+                    {
+                        "busId": bus_id,
+                        "route": route["name"],
+                        "lat": latitude,
+                        "lng": longitude,
+                    }
+                )
+                if len(messages) == amount:
+                    return messages
+
+
+def compare(title, json_messages, positions_amount):
+    for json_message in json_messages:
+        expected = validate_by_marshmallow(json_message)
+        found = validate_message(json_message, MessageSource.bus)["errors"]
+        assert expected == found, f"Errors differ for {json_message}"
+
+    marshmallow_time = timeit.timeit(
+        lambda: [validate_by_marshmallow(msg) for msg in json_messages],
+        number=1,
+    )
+    fast_time = timeit.timeit(
+        lambda: [
+            validate_message(msg, MessageSource.bus) for msg in json_messages
+        ],
+        number=1,
+    )
+
+    print(f"{title}, {positions_amount} positions:")
+    print(f"  marshmallow: {marshmallow_time * 1000:8.1f} ms")
+    print(f"  fast path:   {fast_time * 1000:8.1f} ms")
+    print(f"  speedup:     {marshmallow_time / fast_time:8.1f}x")
+
+
+def check_wrapped_messages():
+    """Positions wrapped into "data" are checked, not the wrapper"""
+    for json_message in ('{"data": [{"foo": 1}]}', '{"data": {"foo": 1}}'):
+        message = validate_message(json_message, MessageSource.bus)
+        assert message["errors"], f"No errors for {json_message}"
+        assert not get_valid_buses(message), f"Passed {json_message}"
+
+
+def check_converted_positions():
+    """Positions passing BusSchema only are stored with float coordinates"""
+    position = {"busId": "1-1", "route": "1", "lat": "55.7", "lng": 37}
+    for data in (position, [position]):
+        message = validate_message(json.dumps(data), MessageSource.bus)
+        assert not message["errors"], f"Errors for {data}"
+        (bus_info,) = get_valid_buses(message)
+        assert bus_info["lat"] == 55.7 and bus_info["lng"] == 37.0
+        assert type(bus_info["lat"]) is float and type(bus_info["lng"]) is float
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--messages", type=int, default=10_000, help="Amount of positions"
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1000,
+        help="Amount of positions in a batch of fake_bus.py",
+    )
+    args = parser.parse_args()
+
+    check_wrapped_messages()
+    check_converted_positions()
+    positions = generate_fake_bus_messages(args.messages)
+
+    single_messages = [json.dumps(position) for position in positions]
+    compare("fake_bus.py single messages", single_messages, len(positions))
+
+    batches = [
+        json.dumps(positions[index : index + args.batch_size])
+        for index in range(0, len(positions), args.batch_size)
+    ]
+    compare("fake_bus.py batches", batches, len(positions))
+
+    broken_messages = ERROR_MESSAGES * (args.messages // len(ERROR_MESSAGES))
+    # Not JSON at all, nothing to compare with marshmallow
+    broken_messages = [
+        message for message in broken_messages if message.startswith('{"')
+    ]
+    compare("harmful_bus.py messages", broken_messages, len(broken_messages))
+
+
+if __name__ == "__main__":
+    main()
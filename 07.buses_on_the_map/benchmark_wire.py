@@ -0,0 +1,143 @@
+"""Compare JSON and binary messages of simulators and browsers.
+
+Browser messages are built for a window with all buses of the fleet inside,
+CPU is measured for one tick of many browsers sharing the same snapshot.
+
+Usage: python3 benchmark_wire.py [--buses 10000] [--browsers 20]
+"""
+
+import argparse
+import json
+import random
+import timeit
+
+from benchmark_grid import generate_buses
+from binary_protocol import PositionsEncoder, decode_positions
+from broadcast import BinaryBrowserFeed, Broadcaster, BrowserFeed
+from models import Bus, MessageSource, WindowBounds
+from storage import BusGrid
+from utils import validate_message
+
+REPEATS = 5  # runs of simulator messages, the best one is reported
+# Window with the whole fleet of benchmark_grid inside
+WHOLE_FLEET_BOUNDS = WindowBounds(
+    south_lat=55.5, north_lat=56.0, west_lng=37.3, east_lng=37.9
+)
+
+
+def move_buses(buses):
+    for bus in buses:
+        bus.lat += random.uniform(-1e-4, 1e-4)
+        bus.lng += random.uniform(-1e-4, 1e-4)
+
+
+def print_comparison(title, json_time, json_size, binary_time, binary_size):
+    print(f"{title}:")
+    print(f"  JSON:   {json_time * 1000:8.2f} ms {json_size / 1024:10.1f} KiB")
+    print(
+        f"  binary: {binary_time * 1000:8.2f} ms {binary_size / 1024:10.1f} KiB"
+    )
+    print(
+        f"  ratio:  {json_time / binary_time:8.1f}x "
+        f"{json_size / binary_size:9.1f}x"
+    )
+
+
+def compare_simulator_messages(buses):
+    batch = [
+        {"busId": bus.busId, "route": bus.route, "lat": bus.lat, "lng": bus.lng}
+        for bus in buses
+    ]
+    encoder = PositionsEncoder()
+    encoder.encode(batch)  # names of buses are sent with the first message
+
+    json_message = json.dumps(batch, ensure_ascii=True)
+    binary_message = encoder.encode(batch)
+    names = {}
+    decode_positions(PositionsEncoder().encode(batch), names)
+
+    def run_json():
+        validate_message(
+            json.dumps(batch, ensure_ascii=True), MessageSource.bus
+        )
+
+    def run_binary():
+        decode_positions(encoder.encode(batch), names)
+
+    # First runs warm up caches, the best of the rest is the least noisy
+    run_json()
+    run_binary()
+    json_time = min(timeit.repeat(run_json, number=1, repeat=REPEATS))
+    binary_time = min(timeit.repeat(run_binary, number=1, repeat=REPEATS))
+    print_comparison(
+        f"Simulator batch of {len(batch)} positions, encode and decode",
+        json_time,
+        len(json_message),
+        binary_time,
+        len(binary_message),
+    )
+
+
+def measure_tick(buses, grid, broadcaster, feeds):
+    """Return CPU seconds and bytes of messages to all feeds in one tick"""
+    move_buses(buses)
+    for bus in buses:
+        grid.update(Bus(bus.busId, bus.route, bus.lat, bus.lng))
+
+    sizes = []
+
+    def run_tick():
+        broadcaster.refresh()
+        for feed in feeds:
+            message, _ = feed.get_message(WHOLE_FLEET_BOUNDS)
+            sizes.append(len(message))
+
+    tick_time = timeit.timeit(run_tick, number=1)
+    return tick_time, sum(sizes)
+
+
+def compare_browser_messages(buses, browsers):
+    results = {}
+    for feed_class in (BrowserFeed, BinaryBrowserFeed):
+        grid = BusGrid()
+        broadcaster = Broadcaster(grid)
+        feeds = [feed_class(broadcaster) for _ in range(browsers)]
+        for bus in buses:
+            grid.update(Bus(bus.busId, bus.route, bus.lat, bus.lng))
+
+        full = measure_tick(buses, grid, broadcaster, feeds)
+        delta = measure_tick(buses, grid, broadcaster, feeds)
+        results[feed_class] = full, delta
+
+    json_full, json_delta = results[BrowserFeed]
+    binary_full, binary_delta = results[BinaryBrowserFeed]
+    print_comparison(
+        f"First tick for {browsers} browsers with {len(buses)} buses",
+        *json_full,
+        *binary_full,
+    )
+    print_comparison(
+        f"Next tick for {browsers} browsers, all buses moved",
+        *json_delta,
+        *binary_delta,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--buses", type=int, default=10_000, help="Amount of buses in window"
+    )
+    parser.add_argument(
+        "--browsers", type=int, default=20, help="Amount of browsers"
+    )
+    args = parser.parse_args()
+
+    random.seed(0)
+    buses = generate_buses(args.buses)
+    compare_simulator_messages(buses)
+    compare_browser_messages(buses, args.browsers)
+
+
+if __name__ == "__main__":
+    main()
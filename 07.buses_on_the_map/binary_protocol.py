@@ -0,0 +1,253 @@
+"""Compact binary messages for simulators and browsers.
+
+Binary messages are used when websocket client proposes SUBPROTOCOL and
+the server accepts it, JSON stays the default. All numbers are
+little-endian:
+
+    message type (uint8) | seq (uint32, server messages only) | sections
+
+Sections go in this order and every one of them starts with the amount
+of its items (uint32):
+
+    names      number (uint32) | busId length (uint32) | busId utf8
+               | route length (uint32) | route utf8
+    positions  number (uint32) | lat (float32) | lng (float32)
+    removed    number (uint32)
+    clusters   lat (float32) | lng (float32) | count (uint32)
+
+Bus id and route are sent once per connection in 'names', positions
+refer to buses by their numbers. Message of simulator has names and
+positions, 'Buses' message of server has names and positions of all
+buses, 'BusesDelta' has names, added positions, moved positions and
+removed numbers, 'Clusters' has empty names and clusters.
+"""
+
+import math
+import struct
+
+SUBPROTOCOL = "buses.binary.v1"
+
+POSITIONS_TYPE = 1  # from simulator
+BUSES_TYPE = 2
+BUSES_DELTA_TYPE = 3
+CLUSTERS_TYPE = 4
+
+MESSAGE_TYPE = struct.Struct("<B")
+SERVER_HEADER = struct.Struct("<BI")
+COUNT = struct.Struct("<I")
+POSITION = struct.Struct("<Iff")
+CLUSTER = struct.Struct("<ffI")
+
+
+def choose_subprotocol(request):
+    """Return subprotocol to accept websocket request with"""
+    if SUBPROTOCOL in request.proposed_subprotocols:
+        return SUBPROTOCOL
+    return None
+
+
+def pack_name(number, bus_id, route):
+    bus_id, route = bus_id.encode(), route.encode()
+    return b"".join(
+        [
+            COUNT.pack(number),
+            COUNT.pack(len(bus_id)),
+            bus_id,
+            COUNT.pack(len(route)),
+            route,
+        ]
+    )
+
+
+def get_name_number(name):
+    """Return number of the bus from its packed name"""
+    (number,) = COUNT.unpack_from(name)
+    return number
+
+
+def pack_position(number, lat, lng):
+    return POSITION.pack(number, lat, lng)
+
+
+def pack_section(items):
+    return COUNT.pack(len(items)) + b"".join(items)
+
+
+def pack_numbers(numbers):
+    return COUNT.pack(len(numbers)) + struct.pack(f"<{len(numbers)}I", *numbers)
+
+
+def pack_buses_message(seq, names, positions):
+    return b"".join(
+        [
+            SERVER_HEADER.pack(BUSES_TYPE, seq),
+            pack_section(names),
+            positions,
+        ]
+    )
+
+
+def pack_buses_delta_message(seq, names, added, moved, removed):
+    return b"".join(
+        [
+            SERVER_HEADER.pack(BUSES_DELTA_TYPE, seq),
+            pack_section(names),
+            pack_section(added),
+            pack_section(moved),
+            pack_numbers(removed),
+        ]
+    )
+
+
+def pack_clusters(clusters):
+    """Return section of [(lat, lng, count)] clusters"""
+    return pack_section(
+        [CLUSTER.pack(lat, lng, count) for lat, lng, count in clusters]
+    )
+
+
+def pack_clusters_message(seq, clusters):
+    return b"".join(
+        [
+            SERVER_HEADER.pack(CLUSTERS_TYPE, seq),
+            pack_section([]),
+            clusters,
+        ]
+    )
+
+
+class PositionsEncoder:
+    """Pack positions from a simulator, names of buses are sent once"""
+
+    def __init__(self):
+        self.sent_names = {}  # {bus_id: (number, route)}
+
+    def encode(self, buses):
+        names, positions = [], []
+        for bus in buses:
+            bus_id, route = bus["busId"], bus["route"]
+            number, sent_route = self.sent_names.get(bus_id, (None, None))
+            if number is None:
+                number = len(self.sent_names)
+            if sent_route != route:
+                self.sent_names[bus_id] = number, route
+                names.append(pack_name(number, bus_id, route))
+            positions.append(pack_position(number, bus["lat"], bus["lng"]))
+
+        return b"".join(
+            [
+                MESSAGE_TYPE.pack(POSITIONS_TYPE),
+                pack_section(names),
+                pack_section(positions),
+            ]
+        )
+
+
+def read_text(message, offset):
+    (length,) = COUNT.unpack_from(message, offset)
+    offset += COUNT.size
+    raw_text = message[offset : offset + length]
+    if len(raw_text) != length:
+        raise ValueError("Text is cut off")
+    return bytes(raw_text).decode(), offset + length
+
+
+def read_names(message, offset, names):
+    (amount,) = COUNT.unpack_from(message, offset)
+    offset += COUNT.size
+    for _ in range(amount):
+        (number,) = COUNT.unpack_from(message, offset)
+        bus_id, offset = read_text(message, offset + COUNT.size)
+        route, offset = read_text(message, offset)
+        names[number] = bus_id, route
+    return offset
+
+
+def decode_positions(message, names):
+    """Return positions of simulator message like validate_message does.
+
+    Names of buses are remembered in 'names' {number: (bus_id, route)}
+    for the next messages of the same connection.
+    """
+    result = {"data": [], "errors": {}, "msgType": None}
+
+    try:
+        (message_type,) = MESSAGE_TYPE.unpack_from(message)
+        if message_type != POSITIONS_TYPE:
+            raise ValueError("Unknown message type")
+
+        offset = read_names(message, MESSAGE_TYPE.size, names)
+        (amount,) = COUNT.unpack_from(message, offset)
+        offset += COUNT.size
+        if len(message) != offset + amount * POSITION.size:
+            raise ValueError("Positions are cut off")
+        positions = POSITION.iter_unpack(message[offset:])
+    except (struct.error, ValueError):
+        result["errors"] = ["Requires valid binary message"]
+        return result
+
+    for index, (number, lat, lng) in enumerate(positions):
+        name = names.get(number)
+        if name is None:
+            result["errors"][index] = {"busId": ["Unknown bus number."]}
+        elif not (math.isfinite(lat) and math.isfinite(lng)):
+            result["errors"][index] = {"lat": ["Not a valid number."]}
+
+        bus_id, route = name or (None, None)
+        result["data"].append(
+            {"busId": bus_id, "route": route, "lat": lat, "lng": lng}
+        )
+
+    return result
+
+
+def read_positions(message, offset, names):
+    (amount,) = COUNT.unpack_from(message, offset)
+    offset += COUNT.size
+    positions = []
+    for number, lat, lng in POSITION.iter_unpack(
+        message[offset : offset + amount * POSITION.size]
+    ):
+        bus_id, route = names[number]
+        positions.append(
+            {"busId": bus_id, "route": route, "lat": lat, "lng": lng}
+        )
+    return positions, offset + amount * POSITION.size
+
+
+def decode_buses_message(message, names):
+    """Return server message in the same shape as its JSON version.
+
+    Names of buses are kept in 'names' {number: (bus_id, route)} between
+    messages of the same connection, like browser does.
+    """
+    message_type, seq = SERVER_HEADER.unpack_from(message)
+    offset = read_names(message, SERVER_HEADER.size, names)
+
+    if message_type == BUSES_TYPE:
+        buses, _ = read_positions(message, offset, names)
+        return {"msgType": "Buses", "seq": seq, "buses": buses}
+
+    if message_type == CLUSTERS_TYPE:
+        (amount,) = COUNT.unpack_from(message, offset)
+        offset += COUNT.size
+        clusters = [
+            {"lat": lat, "lng": lng, "count": count}
+            for lat, lng, count in CLUSTER.iter_unpack(
+                message[offset : offset + amount * CLUSTER.size]
+            )
+        ]
+        return {"msgType": "Clusters", "seq": seq, "clusters": clusters}
+
+    added, offset = read_positions(message, offset, names)
+    moved, offset = read_positions(message, offset, names)
+    (amount,) = COUNT.unpack_from(message, offset)
+    numbers = struct.unpack_from(f"<{amount}I", message, offset + COUNT.size)
+    removed = [names.pop(number)[0] for number in numbers]
+    return {
+        "msgType": "BusesDelta",
+        "seq": seq,
+        "added": added,
+        "moved": moved,
+        "removed": removed,
+    }
@@ -0,0 +1,458 @@
+import itertools
+import json
+import time
+
+import trio
+
+from binary_protocol import (
+    pack_buses_delta_message,
+    pack_buses_message,
+    get_name_number,
+    pack_clusters,
+    pack_clusters_message,
+    pack_name,
+    pack_position,
+    pack_section,
+)
+from metrics import Histogram
+
+DURATION_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25]
+REFRESH_SECONDS = Histogram(
+    "buses_tick_refresh_seconds",
+    "Time to refresh snapshot of buses every tick",
+    DURATION_BUCKETS,
+)
+
+
+def serialize_bus(bus):
+    return json.dumps(
+        {"busId": bus.busId, "lat": bus.lat, "lng": bus.lng, "route": bus.route}
+    )
+
+
+def get_bounds_key(bounds):
+    return (
+        bounds.south_lat,
+        bounds.north_lat,
+        bounds.west_lng,
+        bounds.east_lng,
+        bounds.routes,
+    )
+
+
+class Broadcaster:
+    """Build one snapshot of buses per tick and share it among browsers.
+
+    Every bus is serialized once after it has changed and buses of whole
+    grid cells are collected once, so a message for a browser is glued
+    together from cached JSON fragments instead of dumping every bus for
+    every browser.
+
+    Storage with batch queries is asked for buses of all watched bounds
+    at once right after the refresh instead of walking grid cells.
+    Bounds filtered by routes look through buses of these routes only.
+
+    Bounds wider than cluster_span degrees get clusters of buses instead
+    of buses themselves, None turns clustering off. Bounds filtered by
+    routes are never clustered.
+    """
+
+    def __init__(self, buses, tick=0.1, cluster_span=None):
+        self.buses = buses
+        self.tick = tick
+        self.cluster_span = cluster_span
+
+        self.bus_fragments = {}  # {bus_id: json}
+        self.cell_fragments = {}  # {cell: {bus_id: json}}
+
+        # Snapshots built during this tick: {bounds: {bus_id: json}}
+        self.snapshots = {}
+        self.snapshot_jsons = {}  # {bounds: joined json of buses}
+        self.watched_bounds = {}  # {id(bounds): bounds} of connected browsers
+
+        # Binary messages refer to buses by numbers shared among browsers
+        self.bus_numbers = {}  # {bus_id: number}
+        self.number_counter = itertools.count()
+        self.name_fragments = {}  # {bus_id: (route, packed name)}
+        self.position_fragments = {}  # {bus_id: packed position}
+        # {bounds: {bus_id: (packed name, packed position)}}
+        self.binary_snapshots = {}
+        self.snapshot_positions = {}  # {bounds: packed positions section}
+
+        # Clusters built during this tick: {bounds: [(lat, lng, count)]}
+        self.cluster_snapshots = {}
+        self.cluster_jsons = {}  # {bounds: json array of clusters}
+        self.cluster_sections = {}  # {bounds: packed clusters section}
+
+        self.tick_event = trio.Event()
+
+    def refresh(self):
+        """Serialize buses changed since the previous tick"""
+        changed_buses, changed_cells = self.buses.pop_changes()
+
+        for bus_id in changed_buses:
+            bus = self.buses.buses.get(bus_id)
+            self.position_fragments.pop(bus_id, None)
+            if bus is None:
+                self.bus_fragments.pop(bus_id, None)
+                self.bus_numbers.pop(bus_id, None)
+                self.name_fragments.pop(bus_id, None)
+            else:
+                self.bus_fragments[bus_id] = serialize_bus(bus)
+
+        for cell in changed_cells:
+            self.cell_fragments.pop(cell, None)
+
+        self.snapshots.clear()
+        self.snapshot_jsons.clear()
+        self.binary_snapshots.clear()
+        self.snapshot_positions.clear()
+        self.cluster_snapshots.clear()
+        self.cluster_jsons.clear()
+        self.cluster_sections.clear()
+
+        if self.buses.batch_queries:
+            self.prefetch_snapshots()
+
+    def watch(self, bounds):
+        """Keep snapshot of the bounds ready by the start of every tick"""
+        self.watched_bounds[id(bounds)] = bounds
+
+    def unwatch(self, bounds):
+        self.watched_bounds.pop(id(bounds), None)
+
+    def prefetch_snapshots(self):
+        distinct_bounds = {
+            get_bounds_key(bounds): bounds
+            for bounds in self.watched_bounds.values()
+            if not bounds.routes and not self.is_clustered(bounds)
+        }
+        bus_ids_inside = self.buses.get_bus_ids_inside_many(
+            list(distinct_bounds.values())
+        )
+        # Fragments of all stored buses are fresh just after the refresh
+        for key, bus_ids in zip(distinct_bounds, bus_ids_inside):
+            self.snapshots[key] = {
+                bus_id: self.bus_fragments[bus_id] for bus_id in bus_ids
+            }
+
+    def get_bus_fragment(self, bus):
+        # Bus might arrive after the snapshot was refreshed during this tick
+        fragment = self.bus_fragments.get(bus.busId)
+        if fragment is None:
+            fragment = self.bus_fragments[bus.busId] = serialize_bus(bus)
+        return fragment
+
+    def get_bus_number(self, bus_id):
+        number = self.bus_numbers.get(bus_id)
+        if number is None:
+            number = self.bus_numbers[bus_id] = next(self.number_counter)
+        return number
+
+    def get_binary_fragments(self, bus):
+        """Return packed name and packed position of the bus"""
+        route, name = self.name_fragments.get(bus.busId, (None, None))
+        if route != bus.route:
+            number = self.get_bus_number(bus.busId)
+            name = pack_name(number, bus.busId, bus.route)
+            self.name_fragments[bus.busId] = bus.route, name
+
+        position = self.position_fragments.get(bus.busId)
+        if position is None:
+            position = self.position_fragments[bus.busId] = pack_position(
+                self.bus_numbers[bus.busId], bus.lat, bus.lng
+            )
+        return name, position
+
+    def get_cell_fragments(self, cell):
+        if cell not in self.cell_fragments:
+            self.cell_fragments[cell] = {
+                bus_id: self.get_bus_fragment(bus)
+                for bus_id, bus in self.buses.cells[cell].items()
+            }
+        return self.cell_fragments[cell]
+
+    def get_snapshot(self, bounds):
+        """Return {bus_id: json} of buses inside bounds.
+
+        Returned dict is shared among browsers and must not be modified.
+        """
+        key = get_bounds_key(bounds)
+        if key in self.snapshots:
+            return self.snapshots[key]
+
+        if bounds.routes:
+            fragments = {
+                bus.busId: self.get_bus_fragment(bus)
+                for bus in self.buses.get_buses_inside(bounds)
+            }
+            self.snapshots[key] = fragments
+            return fragments
+
+        if self.buses.batch_queries:
+            # Bounds have changed or browser has connected during this tick
+            (bus_ids,) = self.buses.get_bus_ids_inside_many([bounds])
+            fragments = {
+                bus_id: self.get_bus_fragment(self.buses.buses[bus_id])
+                for bus_id in bus_ids
+            }
+            self.snapshots[key] = fragments
+            return fragments
+
+        fragments = {}
+        for cell, is_border in self.buses.get_cells_inside(bounds):
+            if is_border:
+                for bus_id, bus in self.buses.cells[cell].items():
+                    if bounds.is_inside(bus.lat, bus.lng):
+                        fragments[bus_id] = self.get_bus_fragment(bus)
+            else:
+                fragments.update(self.get_cell_fragments(cell))
+
+        self.snapshots[key] = fragments
+        return fragments
+
+    def get_snapshot_json(self, bounds):
+        """Return joined json of buses inside bounds and their amount"""
+        fragments = self.get_snapshot(bounds)
+        key = get_bounds_key(bounds)
+        if key not in self.snapshot_jsons:
+            self.snapshot_jsons[key] = ", ".join(fragments.values())
+        return self.snapshot_jsons[key], len(fragments)
+
+    def get_binary_snapshot(self, bounds):
+        """Return {bus_id: (packed name, packed position)} inside bounds"""
+        key = get_bounds_key(bounds)
+        if key not in self.binary_snapshots:
+            all_buses = self.buses.buses
+            # Bus might be removed after the snapshot was built
+            self.binary_snapshots[key] = {
+                bus_id: self.get_binary_fragments(all_buses[bus_id])
+                for bus_id in self.get_snapshot(bounds)
+                if bus_id in all_buses
+            }
+        return self.binary_snapshots[key]
+
+    def get_snapshot_positions(self, bounds):
+        """Return packed section of positions of buses inside bounds"""
+        key = get_bounds_key(bounds)
+        if key not in self.snapshot_positions:
+            snapshot = self.get_binary_snapshot(bounds)
+            self.snapshot_positions[key] = pack_section(
+                [position for _, position in snapshot.values()]
+            )
+        return self.snapshot_positions[key]
+
+    def is_clustered(self, bounds):
+        """Tell whether browser gets clusters instead of buses"""
+        if self.cluster_span is None or bounds.routes:
+            return False
+        span = max(
+            bounds.north_lat - bounds.south_lat,
+            bounds.east_lng - bounds.west_lng,
+        )
+        return span > self.cluster_span
+
+    def get_clusters(self, bounds):
+        """Return [(lat, lng, count)] of buses inside bounds.
+
+        Returned list is shared among browsers and must not be modified.
+        """
+        key = get_bounds_key(bounds)
+        if key not in self.cluster_snapshots:
+            self.cluster_snapshots[key] = self.buses.cluster_index.get_clusters(
+                bounds
+            )
+        return self.cluster_snapshots[key]
+
+    def get_clusters_json(self, bounds):
+        key = get_bounds_key(bounds)
+        if key not in self.cluster_jsons:
+            self.cluster_jsons[key] = json.dumps(
+                [
+                    {"lat": lat, "lng": lng, "count": count}
+                    for lat, lng, count in self.get_clusters(bounds)
+                ]
+            )
+        return self.cluster_jsons[key]
+
+    def get_clusters_section(self, bounds):
+        key = get_bounds_key(bounds)
+        if key not in self.cluster_sections:
+            self.cluster_sections[key] = pack_clusters(
+                self.get_clusters(bounds)
+            )
+        return self.cluster_sections[key]
+
+    async def wait_for_tick(self):
+        await self.tick_event.wait()
+
+    async def run(self):
+        """Refresh snapshot every tick and wake up all waiting browsers"""
+        while True:
+            started_at = time.perf_counter()
+            self.refresh()
+            REFRESH_SECONDS.observe(time.perf_counter() - started_at)
+            # trio.Event can't be cleared, so waiters of the next tick get
+            # a new one, while the current waiters are woken up
+            tick_event, self.tick_event = self.tick_event, trio.Event()
+            tick_event.set()
+            await trio.sleep(self.tick)
+
+
+class BrowserFeed:
+    """Send to a browser only buses changed since its previous frame.
+
+    Full snapshot is sent first, after bounds change and whenever browser
+    asks for resync because it has missed a frame. Clusters are always
+    sent in full, but only when they have changed.
+    """
+
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+        self.sent_fragments = {}  # {bus_id: json} as browser knows it now
+        self.sent_clusters = None  # clusters shown by browser now
+        self.seq = 0
+        self.resync_required = True
+
+    def request_resync(self):
+        self.resync_required = True
+        self.sent_clusters = None
+
+    def get_message(self, bounds):
+        """Return next message to the browser and amount of buses in it.
+
+        Message is None when nothing has changed since the previous frame.
+        """
+        if self.broadcaster.is_clustered(bounds):
+            return self.get_clusters_message(bounds)
+
+        self.sent_clusters = None
+        if self.resync_required:
+            return self.get_full_message(bounds)
+        return self.get_delta_message(bounds)
+
+    def get_full_message(self, bounds):
+        buses_json, buses_amount = self.broadcaster.get_snapshot_json(bounds)
+
+        self.seq += 1
+        self.sent_fragments = self.broadcaster.get_snapshot(bounds)
+        self.resync_required = False
+
+        message = '{"msgType": "Buses", "seq": %d, "buses": [%s]}' % (
+            self.seq,
+            buses_json,
+        )
+        return message, buses_amount
+
+    def get_clusters_message(self, bounds):
+        clusters = self.broadcaster.get_clusters(bounds)
+        # Browser gets all buses again when it zooms in
+        self.resync_required = True
+        if clusters == self.sent_clusters:
+            return None, 0
+
+        self.seq += 1
+        self.sent_clusters = clusters
+        message = self.pack_clusters_message(bounds)
+        return message, sum(count for _, _, count in clusters)
+
+    def pack_clusters_message(self, bounds):
+        return '{"msgType": "Clusters", "seq": %d, "clusters": %s}' % (
+            self.seq,
+            self.broadcaster.get_clusters_json(bounds),
+        )
+
+    def get_delta_message(self, bounds):
+        fragments = self.broadcaster.get_snapshot(bounds)
+        sent_fragments = self.sent_fragments
+
+        added, moved = [], []
+        for bus_id, fragment in fragments.items():
+            sent_fragment = sent_fragments.get(bus_id)
+            if sent_fragment is None:
+                added.append(bus_id)
+            elif sent_fragment != fragment:
+                moved.append(bus_id)
+
+        removed = [
+            bus_id for bus_id in sent_fragments if bus_id not in fragments
+        ]
+
+        if not (added or moved or removed):
+            return None, 0
+
+        self.seq += 1
+        self.sent_fragments = fragments
+
+        message = self.pack_delta_message(bounds, added, moved, removed)
+        return message, len(added) + len(moved)
+
+    def pack_delta_message(self, bounds, added, moved, removed):
+        fragments = self.broadcaster.get_snapshot(bounds)
+        return (
+            '{"msgType": "BusesDelta", "seq": %d, '
+            '"added": [%s], "moved": [%s], "removed": %s}'
+            % (
+                self.seq,
+                ", ".join(fragments[bus_id] for bus_id in added),
+                ", ".join(fragments[bus_id] for bus_id in moved),
+                json.dumps(removed),
+            )
+        )
+
+
+class BinaryBrowserFeed(BrowserFeed):
+    """Feed of a browser which has accepted binary messages.
+
+    Changes are found the same way as for JSON, but buses are sent as
+    packed positions, and name of a bus is sent only when browser doesn't
+    know it yet. Packed names and positions are shared among browsers.
+    """
+
+    def __init__(self, broadcaster):
+        super().__init__(broadcaster)
+        self.sent_names = {}  # {bus_id: packed name} as browser knows
+
+    def pack_names(self, bus_ids, snapshot):
+        names = []
+        sent_names = self.sent_names
+        for bus_id in bus_ids:
+            name = snapshot[bus_id][0]
+            if sent_names.get(bus_id) != name:
+                sent_names[bus_id] = name
+                names.append(name)
+        return names
+
+    def get_full_message(self, bounds):
+        snapshot = self.broadcaster.get_binary_snapshot(bounds)
+        positions = self.broadcaster.get_snapshot_positions(bounds)
+
+        self.seq += 1
+        self.sent_fragments = self.broadcaster.get_snapshot(bounds)
+        self.resync_required = False
+
+        names = self.pack_names(snapshot, snapshot)
+        return pack_buses_message(self.seq, names, positions), len(snapshot)
+
+    def pack_clusters_message(self, bounds):
+        return pack_clusters_message(
+            self.seq, self.broadcaster.get_clusters_section(bounds)
+        )
+
+    def pack_delta_message(self, bounds, added, moved, removed):
+        snapshot = self.broadcaster.get_binary_snapshot(bounds)
+        added = [bus_id for bus_id in added if bus_id in snapshot]
+        moved = [bus_id for bus_id in moved if bus_id in snapshot]
+        removed = [
+            get_name_number(self.sent_names.pop(bus_id))
+            for bus_id in removed
+            if bus_id in self.sent_names
+        ]
+
+        return pack_buses_delta_message(
+            self.seq,
+            self.pack_names(added + moved, snapshot),
+            [snapshot[bus_id][1] for bus_id in added],
+            [snapshot[bus_id][1] for bus_id in moved],
+            removed,
+        )
@@ -0,0 +1,150 @@
+import numpy as np
+
+from storage import ClusterIndex, RouteIndex, UpdateTimes
+
+BOUNDS_CHUNK_SIZE = 64  # bounds compared with all buses at once
+
+
+class ColumnarBuses:
+    """Buses kept in parallel NumPy arrays, one slot per bus.
+
+    Bounds of all browsers are compared with all buses by one vectorized
+    operation per tick, which beats walking Python objects on large fleets.
+    """
+
+    batch_queries = True  # Broadcaster asks for all browsers at once
+
+    def __init__(self, capacity=1024):
+        self.lats = np.full(capacity, np.nan)
+        self.lngs = np.full(capacity, np.nan)
+        self.slot_bus_ids = np.empty(capacity, dtype=object)
+        self.used_slots = 0  # slots after that one have never been used
+        self.free_slots = []
+
+        self.buses = {}  # {bus_id: bus_info}
+        self.slots = {}  # {bus_id: slot}
+        self.route_index = RouteIndex()
+        self.cluster_index = ClusterIndex()
+        self.update_times = UpdateTimes()
+
+        # What has been touched since the last call of 'pop_changes'
+        self.changed_buses = set()
+
+    def __len__(self):
+        return len(self.buses)
+
+    def __iter__(self):
+        return iter(self.buses.values())
+
+    def _grow(self):
+        capacity = len(self.lats) * 2
+        for name, filler in [
+            ("lats", np.nan),
+            ("lngs", np.nan),
+            ("slot_bus_ids", None),
+        ]:
+            column = getattr(self, name)
+            grown_column = np.full(capacity, filler, dtype=column.dtype)
+            grown_column[: len(column)] = column
+            setattr(self, name, grown_column)
+
+    def _take_slot(self, bus_id):
+        if self.free_slots:
+            slot = self.free_slots.pop()
+        else:
+            if self.used_slots == len(self.lats):
+                self._grow()
+            slot = self.used_slots
+            self.used_slots += 1
+
+        self.slots[bus_id] = slot
+        self.slot_bus_ids[slot] = bus_id
+        return slot
+
+    def update(self, bus):
+        slot = self.slots.get(bus.busId)
+        if slot is None:
+            slot = self._take_slot(bus.busId)
+
+        self.lats[slot] = bus.lat
+        self.lngs[slot] = bus.lng
+
+        previous_bus = self.buses.get(bus.busId)
+        self.route_index.add(bus, previous_bus)
+        self.cluster_index.add(bus, previous_bus)
+        self.buses[bus.busId] = bus
+        self.changed_buses.add(bus.busId)
+        self.update_times.touch(bus.busId)
+
+    def remove(self, bus_id):
+        bus = self.buses.pop(bus_id, None)
+        if bus is not None:
+            self.route_index.discard(bus)
+            self.cluster_index.discard(bus)
+        self.update_times.discard(bus_id)
+        slot = self.slots.pop(bus_id, None)
+        if slot is None:
+            return
+
+        # NaN is never inside any bounds, so the slot is skipped by queries
+        self.lats[slot] = np.nan
+        self.lngs[slot] = np.nan
+        self.slot_bus_ids[slot] = None
+        self.free_slots.append(slot)
+        self.changed_buses.add(bus_id)
+
+    def evict_stale(self, max_age):
+        """Remove buses not updated for max_age seconds, return amount"""
+        stale_bus_ids = self.update_times.pop_stale(max_age)
+        for bus_id in stale_bus_ids:
+            self.remove(bus_id)
+        return len(stale_bus_ids)
+
+    def pop_changes(self):
+        """Return ids of changed buses and cells and start tracking anew.
+
+        There are no cells here, so the set of changed cells is always empty.
+        """
+        changed_buses, self.changed_buses = self.changed_buses, set()
+        return changed_buses, set()
+
+    def get_bus_ids_inside_many(self, bounds_list):
+        """Return list of bus ids inside every bounds of the list.
+
+        Routes of bounds are not taken into account here.
+        """
+        lats = self.lats[: self.used_slots]
+        lngs = self.lngs[: self.used_slots]
+        slot_bus_ids = self.slot_bus_ids[: self.used_slots]
+
+        bus_ids_inside = []
+        for start in range(0, len(bounds_list), BOUNDS_CHUNK_SIZE):
+            chunk = bounds_list[start : start + BOUNDS_CHUNK_SIZE]
+            south_lats, north_lats, west_lngs, east_lngs = np.array(
+                [
+                    (
+                        bounds.south_lat,
+                        bounds.north_lat,
+                        bounds.west_lng,
+                        bounds.east_lng,
+                    )
+                    for bounds in chunk
+                ]
+            ).T[:, :, np.newaxis]
+
+            masks = (
+                (south_lats < lats)
+                & (lats < north_lats)
+                & (west_lngs < lngs)
+                & (lngs < east_lngs)
+            )
+            bus_ids_inside.extend(slot_bus_ids[mask].tolist() for mask in masks)
+
+        return bus_ids_inside
+
+    def get_buses_inside(self, bounds):
+        if bounds.routes:
+            return self.route_index.get_buses_inside(bounds)
+
+        (bus_ids,) = self.get_bus_ids_inside_many([bounds])
+        return [self.buses[bus_id] for bus_id in bus_ids]
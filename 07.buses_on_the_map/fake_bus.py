@@ -2,16 +2,31 @@ import contextlib
 import json
 import itertools
 import logging
+import multiprocessing
+import queue
 import random
 import asyncclick as click
 import functools
+from dataclasses import dataclass
 
 import trio
 from trio_websocket import open_websocket_url, ConnectionClosed, HandshakeError
+
+from binary_protocol import SUBPROTOCOL, PositionsEncoder
+from playback import Playback, RouteTrack
 from utils import generate_bus_id, load_routes
 
 logger = logging.getLogger("app_logger")
 
+STATS_INTERVAL = 5  # seconds between reports of workers throughput
+# Speed of every bus differs from the given one by this share at most
+SPEED_SPREAD = 0.2
+
+
+@dataclass
+class SendStats:
+    sent: int = 0  # amount of bus positions sent to server
+
 
 def relaunch_on_disconnect(async_function):
     # TODO: increase counter each next attempt (easy),
@@ -31,41 +46,187 @@ def relaunch_on_disconnect(async_function):
     return inner
 
 
-async def run_bus(bus_id, route, send_channel):
-    # Template message to send to the channel with updated values each time
-    message = {"busId": None, "lat": None, "lng": None, "route": None}
+async def run_playback(playback, send_channels, refresh_timeout):
+    """Move all buses every tick and hand their positions to websockets"""
+    previous_time = trio.current_time()
+    while True:
+        now = trio.current_time()
+        positions = playback.advance(now - previous_time)
+        previous_time = now
+
+        # Every bus is sent through the same websocket all the time
+        for index, send_channel in enumerate(send_channels):
+            # Websocket still sending previous tick skips this one,
+            # so a slow or reconnecting one doesn't stop other buses
+            with contextlib.suppress(trio.WouldBlock):
+                send_channel.send_nowait(positions[index :: len(send_channels)])
+
+        await trio.sleep_until(now + refresh_timeout)
+
+
+@relaunch_on_disconnect
+async def send_updates(
+    server_address, receive_channel, batch_size, binary, stats
+):
+    subprotocols = [SUBPROTOCOL] if binary else None
+    async with open_websocket_url(
+        server_address, subprotocols=subprotocols
+    ) as ws:
+        # Server which doesn't know binary messages accepts JSON only
+        encoder = PositionsEncoder() if ws.subprotocol == SUBPROTOCOL else None
+        async for positions in receive_channel:
+            for start in range(0, len(positions), batch_size):
+                batch = positions[start : start + batch_size]
+                if encoder:
+                    await ws.send_message(encoder.encode(batch))
+                else:
+                    await ws.send_message(json.dumps(batch, ensure_ascii=True))
+                stats.sent += len(batch)
+
+
+async def run_emulator(
+    server,
+    routes,
+    buses_per_route,
+    websockets_number,
+    emulator_id,
+    refresh_timeout,
+    speed,
+    batch_size,
+    binary,
+    stats,
+):
+    playback = Playback()
+    for route in routes:
+        track = RouteTrack(route["name"], route["coordinates"])
+        for bus_number in range(1, buses_per_route + 1):
+            bus_id = generate_bus_id(emulator_id, route["name"], bus_number)
+            bus_speed = speed * random.uniform(
+                1 - SPEED_SPREAD, 1 + SPEED_SPREAD
+            )
+            playback.add_bus(bus_id, track, bus_speed)
+
+    try:
+        async with trio.open_nursery() as nursery:
+            send_channels = []
+            for _ in range(websockets_number):
+                # Positions of one tick wait for their websocket at most
+                send_channel, receive_channel = trio.open_memory_channel(1)
+                send_channels.append(send_channel)
+
+                nursery.start_soon(
+                    send_updates,
+                    server,
+                    receive_channel,
+                    batch_size,
+                    binary,
+                    stats,
+                )
+
+            nursery.start_soon(
+                run_playback, playback, send_channels, refresh_timeout
+            )
+
+    except OSError as ose:
+        logger.debug("Connection attempt failed: %s", ose)
+
+
+def get_worker_emulator_id(emulator_id, worker_index):
+    return "-".join(filter(None, [emulator_id, f"w{worker_index}"]))
+
+
+async def report_stats(stats, stats_queue, worker_index):
+    while True:
+        await trio.sleep(STATS_INTERVAL)
+        stats_queue.put((worker_index, stats.sent))
+
+
+async def run_worker_emulator(
+    worker_index, workers, routes_number, stats_queue, emulator_options
+):
+    # Every worker owns its own shard of routes and its own websockets
+    routes = list(itertools.islice(load_routes(), routes_number))
+    stats = SendStats()
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(report_stats, stats, stats_queue, worker_index)
+        await run_emulator(
+            routes=routes[worker_index::workers],
+            stats=stats,
+            **emulator_options,
+        )
+        nursery.cancel_scope.cancel()
 
-    coordinates = route["coordinates"]
 
-    # set starting point for different bus
-    # with different coordinates om the same route
-    start_offset = random.randrange(len(coordinates))
+def run_worker(worker_index, workers, routes_number, stats_queue, options):
+    """Entry point of an emulator process"""
+    options["emulator_id"] = get_worker_emulator_id(
+        options["emulator_id"], worker_index
+    )
+    with contextlib.suppress(KeyboardInterrupt):
+        trio.run(
+            run_worker_emulator,
+            worker_index,
+            workers,
+            routes_number,
+            stats_queue,
+            options,
+        )
+
 
-    # infinite loop to circle the route (start again after finish)
+async def collect_stats(stats_queue, workers):
+    """Print positions sent by every worker and all of them together"""
+    sent_by_workers = [0] * workers
     while True:
-        for latitude, longitude in coordinates[start_offset:]:
-            message.update(
-                {
-                    "busId": bus_id,
-                    "route": route["name"],
-                    "lat": latitude,
-                    "lng": longitude,
-                }
+        previous_sent_by_workers = list(sent_by_workers)
+        await trio.sleep(STATS_INTERVAL)
+
+        with contextlib.suppress(queue.Empty):
+            while True:
+                worker_index, sent = stats_queue.get_nowait()
+                sent_by_workers[worker_index] = sent
+
+        rates = [
+            (sent - previous_sent) / STATS_INTERVAL
+            for sent, previous_sent in zip(
+                sent_by_workers, previous_sent_by_workers
             )
+        ]
+        workers_rates = ", ".join(f"{rate:.0f}" for rate in rates)
+        click.echo(
+            f"Sent {sum(sent_by_workers)} bus positions, "
+            f"{sum(rates):.0f} per second (by workers: {workers_rates})"
+        )
 
-            await send_channel.send(message)
 
-        # Reset offset after first iteration to start route from the beginning
-        start_offset = 0
+async def run_workers(workers, routes_number, emulator_options):
+    # 'spawn' gives every worker a clean interpreter to start its own trio
+    context = multiprocessing.get_context("spawn")
+    stats_queue = context.Queue()
 
+    processes = [
+        context.Process(
+            target=run_worker,
+            args=(
+                worker_index,
+                workers,
+                routes_number,
+                stats_queue,
+                emulator_options,
+            ),
+            daemon=True,
+        )
+        for worker_index in range(workers)
+    ]
+    for process in processes:
+        process.start()
 
-@relaunch_on_disconnect
-async def send_updates(server_address, receive_channel, refresh_timeout):
-    async with open_websocket_url(server_address) as ws:
-        async for value in receive_channel:
-            await ws.send_message(json.dumps(value, ensure_ascii=True))
-            # without that delay buses go crazy on the map
-            await trio.sleep(refresh_timeout)
+    try:
+        await collect_stats(stats_queue, workers)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
 
 
 @click.command()
@@ -111,6 +272,34 @@ async def send_updates(server_address, receive_channel, refresh_timeout):
     type=float,
     help="Delay of server coordinates refreshing",
 )
+@click.option(
+    "--speed",
+    default=30.0,
+    show_default=True,
+    type=float,
+    help="Average speed of buses, km/h",
+)
+@click.option(
+    "--batch_size",
+    default=1000,
+    show_default=True,
+    type=int,
+    help="Max amount of bus positions in one message",
+)
+@click.option(
+    "--binary",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Send positions in binary messages if server supports them",
+)
+@click.option(
+    "--workers",
+    default=1,
+    show_default=True,
+    type=int,
+    help="Amount of emulator processes sharing routes among them",
+)
 @click.option(
     "--verbose",
     "-v",
@@ -126,38 +315,31 @@ async def main(
     websockets_number,
     emulator_id,
     refresh_timeout,
+    speed,
+    batch_size,
+    binary,
+    workers,
     verbose,
 ):
     if not verbose:
         logger.disabled = True
 
-    send_channels = []
-    try:
-        async with trio.open_nursery() as nursery:
+    emulator_options = {
+        "server": server,
+        "buses_per_route": buses_per_route,
+        "websockets_number": websockets_number,
+        "emulator_id": emulator_id,
+        "refresh_timeout": refresh_timeout,
+        "speed": speed,
+        "batch_size": batch_size,
+        "binary": binary,
+    }
 
-            # Prepare memory channels: separate task for every 'receive_channel'
-            # and accumulate 'send_channel's to be randomly selected afterwards
-            for _ in range(websockets_number):
-                send_channel, receive_channel = trio.open_memory_channel(0)
-                send_channels.append(send_channel)
-
-                nursery.start_soon(
-                    send_updates, server, receive_channel, refresh_timeout
-                )
-
-            for bus_number in range(1, buses_per_route + 1):
-                for route in itertools.islice(load_routes(), routes_number):
-                    bus_id = generate_bus_id(
-                        emulator_id, route["name"], bus_number
-                    )
-
-                    # Pick random 'send' channel for every bus
-                    send_channel = random.choice(send_channels)
-
-                    nursery.start_soon(run_bus, bus_id, route, send_channel)
-
-    except OSError as ose:
-        logger.debug("Connection attempt failed: %s", ose)
+    if workers > 1:
+        await run_workers(workers, routes_number, emulator_options)
+    else:
+        routes = list(itertools.islice(load_routes(), routes_number))
+        await run_emulator(routes=routes, stats=SendStats(), **emulator_options)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,123 @@
+"""Counters and histograms of server hot paths in Prometheus text format.
+
+Updating a metric is a couple of additions, the text is built only when
+somebody fetches it from the HTTP port.
+"""
+
+import bisect
+import contextlib
+
+import trio
+
+REGISTRY = []  # all metrics in the order they are rendered
+SCRAPE_TIMEOUT = 5  # seconds to wait for the request of a scraper
+MAX_REQUEST_SIZE = 8192
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        REGISTRY.append(self)
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {self.value}",
+        ]
+
+
+class Gauge:
+    """Value read by get_value function at the time of scraping"""
+
+    def __init__(self, name, help_text, get_value):
+        self.name = name
+        self.help_text = help_text
+        self.get_value = get_value
+        REGISTRY.append(self)
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.get_value()}",
+        ]
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = sorted(buckets)
+        # Observations per bucket, the last one is for values above all
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        REGISTRY.append(self)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} histogram",
+        ]
+        cumulative_count = 0
+        for bucket, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative_count += count
+            lines.append(
+                f'{self.name}_bucket{{le="{bucket}"}} {cumulative_count}'
+            )
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {cumulative_count}")
+        return lines
+
+
+def render_metrics():
+    return "\n".join(line for metric in REGISTRY for line in metric.render())
+
+
+async def answer_scrape(stream):
+    """Answer a plain HTTP request with metrics, any path but /metrics is 404"""
+    request = b""
+    with trio.move_on_after(SCRAPE_TIMEOUT):
+        while b"\r\n\r\n" not in request and len(request) < MAX_REQUEST_SIZE:
+            chunk = await stream.receive_some()
+            if not chunk:
+                break
+            request += chunk
+
+    request_line = request.split(b"\r\n", 1)[0].split()
+    if len(request_line) >= 2 and request_line[1].split(b"?")[0] == b"/metrics":
+        status = "200 OK"
+        body = (render_metrics() + "\n").encode()
+    else:
+        status = "404 Not Found"
+        body = b"Metrics are at /metrics\n"
+
+    head = (
+        f"HTTP/1.1 {status}\r\n"
+        "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    )
+    await stream.send_all(head.encode() + body)
+    await stream.aclose()
+
+
+async def handle_scrape(stream):
+    # Scraper that has gone away must not stop the server
+    with contextlib.suppress(
+        trio.BrokenResourceError, trio.ClosedResourceError
+    ):
+        await answer_scrape(stream)
+
+
+async def serve_metrics(host, port):
+    await trio.serve_tcp(handle_scrape, port, host=host)
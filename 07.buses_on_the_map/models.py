@@ -2,12 +2,22 @@ from dataclasses import dataclass
 from enum import Enum
 
 
-@dataclass
 class Bus:
-    busId: str
-    route: str
-    lat: float
-    lng: float
+    """Position of a bus, thousands of them are kept by server at once"""
+
+    __slots__ = ("busId", "route", "lat", "lng")
+
+    def __init__(self, busId, route, lat, lng):
+        self.busId = busId
+        self.route = route
+        self.lat = lat
+        self.lng = lng
+
+    def __repr__(self):
+        return (
+            f"Bus(busId={self.busId!r}, route={self.route!r}, "
+            f"lat={self.lat!r}, lng={self.lng!r})"
+        )
 
 
 @dataclass
@@ -17,22 +27,38 @@ class WindowBounds:
     north_lat: float = 0.0
     west_lng: float = 0.0
     east_lng: float = 0.0
+    routes: frozenset = None  # show buses of all routes when None
 
     def is_inside(self, lat, lng):
         lat_inside = self.south_lat < lat < self.north_lat
         lng_inside = self.west_lng < lng < self.east_lng
         return lat_inside and lng_inside
 
-    def update(self, south_lat, north_lat, west_lng, east_lng):
+    def update(self, south_lat, north_lat, west_lng, east_lng, routes=None):
         self.south_lat = south_lat
         self.north_lat = north_lat
         self.west_lng = west_lng
         self.east_lng = east_lng
+        self.routes = frozenset(routes) if routes else None
 
     def register_errors(self, errors):
         self.errors = errors
 
 
+@dataclass(eq=False)
+class BrowserConnection:
+    hidden: bool = False  # browser tab is in background
+    last_sent_at: float = float("-inf")
+    sent_frames: int = 0
+    # Ticks skipped because previous frame was still being sent
+    dropped_frames: int = 0
+    # Frames carrying changes of dropped ticks along with their own
+    coalesced_frames: int = 0
+
+    def set_visibility(self, hidden):
+        self.hidden = hidden
+
+
 class MessageSource(Enum):
     bus = "bus"
     browser = "browser"
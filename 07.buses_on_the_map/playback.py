@@ -0,0 +1,112 @@
+"""Time-based movement of simulated buses along their routes.
+
+Every bus drives at its own speed, its position is interpolated between
+points of the route by the distance passed, so it doesn't depend on how
+often positions are taken or how dense the points of the route are.
+"""
+
+import bisect
+import math
+import random
+from array import array
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def get_distance_km(lat1, lng1, lat2, lng2):
+    """Return great-circle distance between two points"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    haversine = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(haversine))
+
+
+class RouteTrack:
+    """Points of a route with distances to them from the start.
+
+    Track is computed once per route and shared by all buses of the route.
+    """
+
+    def __init__(self, name, coordinates):
+        self.name = name
+        self.lats = array("d")
+        self.lngs = array("d")
+        self.distances = array("d")  # km from the start to every point
+
+        distance = 0.0
+        for lat, lng in coordinates:
+            if self.lats:
+                distance += get_distance_km(
+                    self.lats[-1], self.lngs[-1], lat, lng
+                )
+            self.lats.append(lat)
+            self.lngs.append(lng)
+            self.distances.append(distance)
+
+    @property
+    def length(self):
+        return self.distances[-1] if self.distances else 0.0
+
+    def get_position(self, distance):
+        """Return (lat, lng) of the point the distance away from the start"""
+        index = bisect.bisect_right(self.distances, distance) - 1
+        if index >= len(self.distances) - 1:
+            return self.lats[-1], self.lngs[-1]
+
+        # Points of zero segments are skipped by bisect, so length is not 0
+        segment_start = self.distances[index]
+        segment_length = self.distances[index + 1] - segment_start
+        fraction = (distance - segment_start) / segment_length
+
+        lat, next_lat = self.lats[index], self.lats[index + 1]
+        lng, next_lng = self.lngs[index], self.lngs[index + 1]
+        return (
+            lat + (next_lat - lat) * fraction,
+            lng + (next_lng - lng) * fraction,
+        )
+
+
+class Playback:
+    """All simulated buses moved together by one scheduler.
+
+    Buses are kept in flat arrays instead of a task per bus, so memory
+    stays flat however many buses there are.
+    """
+
+    def __init__(self):
+        self.bus_ids = []
+        self.tracks = []  # shared RouteTrack of every bus
+        self.distances = array("d")  # km passed from the start of the route
+        self.speeds = array("d")  # km per second
+
+    def __len__(self):
+        return len(self.bus_ids)
+
+    def add_bus(self, bus_id, track, speed):
+        """Put bus with speed in km/h at a random point of the track"""
+        self.bus_ids.append(bus_id)
+        self.tracks.append(track)
+        self.distances.append(random.uniform(0, track.length))
+        self.speeds.append(speed / 3600)
+
+    def advance(self, elapsed):
+        """Move buses by elapsed seconds and return their positions.
+
+        Bus starts the route again after its end.
+        """
+        positions = []
+        distances, speeds = self.distances, self.speeds
+        for index, (bus_id, track) in enumerate(zip(self.bus_ids, self.tracks)):
+            distance = distances[index] + speeds[index] * elapsed
+            if distance >= track.length:
+                distance = distance % track.length if track.length else 0.0
+            distances[index] = distance
+
+            lat, lng = track.get_position(distance)
+            # New dict every time: it may wait in a channel for sending
+            positions.append(
+                {"busId": bus_id, "route": track.name, "lat": lat, "lng": lng}
+            )
+        return positions
@@ -0,0 +1,107 @@
+"""Send simulator messages recorded by 'server.py --record' to a server.
+
+Every recorded connection is replayed over its own websocket with the
+same subprotocol, messages keep their order and, unless the speed is 0,
+their timing.
+
+Usage: python3 replay.py simulators.log.gz [--speed 1] [--server ws://...]
+"""
+
+import contextlib
+import time
+from dataclasses import dataclass
+
+import asyncclick as click
+import trio
+from trio_websocket import open_websocket_url
+
+from traffic_log import BINARY, CLOSE, OPEN, TEXT, read_records
+
+# Messages of a connection waiting for its websocket at most
+CONNECTION_QUEUE_SIZE = 100
+
+
+@dataclass
+class ReplayStats:
+    connections: int = 0
+    sent: int = 0  # messages sent to server
+
+
+async def replay_connection(server, subprotocol, receive_channel, stats):
+    subprotocols = [subprotocol] if subprotocol else None
+    async with open_websocket_url(server, subprotocols=subprotocols) as ws:
+        if ws.subprotocol != subprotocol:
+            click.echo(
+                f"Server hasn't accepted subprotocol {subprotocol}", err=True
+            )
+        async with receive_channel:
+            async for message in receive_channel:
+                await ws.send_message(message)
+                stats.sent += 1
+
+
+async def replay(path, server, speed, stats):
+    send_channels = {}  # {connection: send_channel}
+    started_at = trio.current_time()
+
+    async with trio.open_nursery() as nursery:
+        for kind, timestamp, connection, payload in read_records(path):
+            if speed:
+                await trio.sleep_until(started_at + timestamp / speed)
+
+            if kind == OPEN:
+                send_channel, receive_channel = trio.open_memory_channel(
+                    CONNECTION_QUEUE_SIZE
+                )
+                send_channels[connection] = send_channel
+                stats.connections += 1
+                nursery.start_soon(
+                    replay_connection,
+                    server,
+                    payload.decode() or None,
+                    receive_channel,
+                    stats,
+                )
+            elif kind == CLOSE:
+                await send_channels.pop(connection).aclose()
+            elif kind == TEXT:
+                await send_channels[connection].send(payload.decode())
+            elif kind == BINARY:
+                await send_channels[connection].send(payload)
+
+        # Connections open till the end of recording are closed after it
+        for send_channel in send_channels.values():
+            await send_channel.aclose()
+
+
+@click.command()
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--server",
+    default="ws://127.0.0.1:8080",
+    show_default=True,
+    type=str,
+    help="Server address",
+)
+@click.option(
+    "--speed",
+    default=1.0,
+    show_default=True,
+    type=float,
+    help="Times faster than recorded, 0 to send as fast as possible",
+)
+async def main(path, server, speed):
+    stats = ReplayStats()
+    started_at = time.monotonic()
+    await replay(path, server, speed, stats)
+    elapsed = time.monotonic() - started_at
+
+    click.echo(
+        f"Replayed {stats.sent} messages of {stats.connections} connections "
+        f"in {elapsed:.1f} s, {stats.sent / elapsed:.0f} per second"
+    )
+
+
+if __name__ == "__main__":
+    with contextlib.suppress(KeyboardInterrupt):
+        main(_anyio_backend="trio")
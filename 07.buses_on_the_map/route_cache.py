@@ -0,0 +1,162 @@
+"""Binary cache of bus routes to avoid parsing route JSON files every start.
+
+Cache file layout:
+    MAGIC | header length (8 bytes) | JSON header | padding | float64 values
+
+JSON header keeps fingerprints of source files and index of routes:
+name, offset and amount of points in the flat array of lat, lng values.
+Cache is rebuilt as soon as any source file is added, removed or changed.
+
+Usage: python3 route_cache.py [--routes routes]
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from collections.abc import Sequence
+
+MAGIC = f"ROUTES1{sys.byteorder[0]}".encode()
+HEADER_LENGTH = struct.Struct("<Q")
+VALUE_SIZE = array("d").itemsize
+
+
+class Coordinates(Sequence):
+    """Read-only list of (lat, lng) pairs over flat float64 values"""
+
+    def __init__(self, values):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values) // 2
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[position] for position in range(start, stop, step)]
+            return Coordinates(self.values[start * 2 : max(start, stop) * 2])
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Coordinates index out of range")
+        return self.values[index * 2], self.values[index * 2 + 1]
+
+    def __iter__(self):
+        return zip(self.values[::2], self.values[1::2])
+
+
+def get_cache_path(directory_path):
+    return os.path.normpath(directory_path) + ".cache"
+
+
+def get_sources(directory_path):
+    """Return {filename: [size, mtime]} of route files in the directory"""
+    return {
+        entry.name: [entry.stat().st_size, entry.stat().st_mtime_ns]
+        for entry in os.scandir(directory_path)
+        if entry.name.endswith(".json")
+    }
+
+
+def read_routes_json(directory_path, filenames):
+    for filename in filenames:
+        filepath = os.path.join(directory_path, filename)
+        with open(filepath, "r", encoding="utf8") as file:
+            yield json.load(file)
+
+
+def compile_routes(directory_path="routes"):
+    """Parse route files and write them into the binary cache"""
+    sources = get_sources(directory_path)
+
+    values = array("d")
+    index = []
+    for route in read_routes_json(directory_path, sorted(sources)):
+        offset = len(values)
+        for latitude, longitude in route["coordinates"]:
+            values.append(latitude)
+            values.append(longitude)
+        index.append([route["name"], offset, len(route["coordinates"])])
+
+    header = json.dumps({"sources": sources, "routes": index}).encode()
+    prefix_length = len(MAGIC) + HEADER_LENGTH.size + len(header)
+    padding = -prefix_length % VALUE_SIZE
+
+    cache_path = get_cache_path(directory_path)
+    # Write to a temporary file first: other emulators may read cache now
+    file_descriptor, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(cache_path) or "."
+    )
+    with os.fdopen(file_descriptor, "wb") as file:
+        file.write(MAGIC)
+        file.write(HEADER_LENGTH.pack(len(header)))
+        file.write(header)
+        file.write(b"\0" * padding)
+        values.tofile(file)
+    os.replace(temp_path, cache_path)
+
+
+def open_cache(directory_path):
+    """Return header and float64 values of memory-mapped cache.
+
+    None is returned when there is no cache yet or it's outdated.
+    """
+    try:
+        with open(get_cache_path(directory_path), "rb") as file:
+            cache = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    if cache[: len(MAGIC)] != MAGIC:
+        return None
+
+    (header_length,) = HEADER_LENGTH.unpack_from(cache, len(MAGIC))
+    header_start = len(MAGIC) + HEADER_LENGTH.size
+    header = json.loads(cache[header_start : header_start + header_length])
+
+    if header["sources"] != get_sources(directory_path):
+        return None
+
+    prefix_length = header_start + header_length
+    values_start = prefix_length + (-prefix_length % VALUE_SIZE)
+    return header, memoryview(cache)[values_start:].cast("d")
+
+
+def load_cached_routes(directory_path="routes"):
+    """Return routes from the cache, compile it first if needed"""
+    opened_cache = open_cache(directory_path)
+    if opened_cache is None:
+        compile_routes(directory_path)
+        opened_cache = open_cache(directory_path)
+
+    header, values = opened_cache
+
+    return [
+        {
+            "name": name,
+            "coordinates": Coordinates(values[offset : offset + points * 2]),
+        }
+        for name, offset, points in header["routes"]
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--routes", default="routes", help="Directory with route JSON files"
+    )
+    args = parser.parse_args()
+
+    compile_routes(args.routes)
+    routes = load_cached_routes(args.routes)
+    print(f"{len(routes)} routes cached to {get_cache_path(args.routes)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,11 +8,28 @@ class WindowBoundsSchema(Schema):
     data = fields.Nested("WindowBoundsDataSchema", required=True)
 
 
+class ResyncSchema(Schema):
+    msgType = fields.String(required=True, validate=validate.OneOf(["resync"]))
+
+
+class TabVisibilitySchema(Schema):
+    msgType = fields.String(
+        required=True, validate=validate.OneOf(["tabVisibility"])
+    )
+    data = fields.Nested("TabVisibilityDataSchema", required=True)
+
+
+class TabVisibilityDataSchema(Schema):
+    hidden = fields.Boolean(required=True, truthy={True}, falsy={False})
+
+
 class WindowBoundsDataSchema(Schema):
     south_lat = fields.Float(required=True)
     north_lat = fields.Float(required=True)
     west_lng = fields.Float(required=True)
     east_lng = fields.Float(required=True)
+    # Only buses of these routes are sent when given
+    routes = fields.List(fields.String())
 
 
 class BusSchema(Schema):
@@ -1,13 +1,30 @@
 import contextlib
+import functools
 import json
 import logging
+import multiprocessing
+import os
+import signal
+import time
 import asyncclick as click
 
 import trio
-from trio_websocket import serve_websocket, ConnectionClosed
+from trio_websocket import serve_websocket, ConnectionClosed, WebSocketServer
 
-from models import WindowBounds, Bus, MessageSource
+from binary_protocol import SUBPROTOCOL, choose_subprotocol, decode_positions
+from broadcast import (
+    DURATION_BUCKETS,
+    BinaryBrowserFeed,
+    Broadcaster,
+    BrowserFeed,
+)
+from metrics import Counter, Gauge, Histogram, serve_metrics
+from models import WindowBounds, Bus, BrowserConnection, MessageSource
+from shared_table import SharedBusTable, TableReader, TableWriter
+from storage import BusGrid
+from traffic_log import TrafficRecorder
 from utils import (
+    get_valid_buses,
     validate_bus_message,
     validate_client_message,
     validate_message,
@@ -15,50 +32,149 @@ from utils import (
 
 logger = logging.getLogger("app_logger")
 
-buses = {}  # global variable to collect buses info -  {bus_id: bus_info}
+buses = BusGrid()  # global variable to collect buses info indexed by position
+broadcaster = Broadcaster(buses)  # shares serialized buses among browsers
+browser_connections = set()  # state and frame counters of connected browsers
+simulator_connections = set()  # websockets of connected simulators
+recorder = None  # TrafficRecorder writing simulator messages if asked for
 
+# Seconds between frames to a browser tab in background
+HIDDEN_TAB_INTERVAL = 1.0
+# Buses not updated for that many seconds are removed from the map
+BUS_TTL = 30.0
+STORAGES = ["grid", "columnar"]
+# Bus positions shared among worker processes at most
+TABLE_CAPACITY = 100_000
+# Seconds between checks of a worker that the server is still running
+PARENT_CHECK_INTERVAL = 1.0
+# Browser showing more degrees than that gets clusters instead of buses
+CLUSTER_SPAN = 0.2
 
-async def send_buses(ws, bounds):
-    buses_inside = [
-        bus_info
-        for _, bus_info in buses.items()
-        if bounds.is_inside(bus_info.lat, bus_info.lng)
-    ]
+SIMULATOR_MESSAGES = Counter(
+    "buses_simulator_messages_total", "Messages received from simulators"
+)
+INVALID_SIMULATOR_MESSAGES = Counter(
+    "buses_simulator_invalid_messages_total",
+    "Messages from simulators with validation errors",
+)
+INGESTED_POSITIONS = Counter(
+    "buses_ingested_positions_total", "Valid bus positions stored"
+)
+FRAME_SECONDS = Histogram(
+    "buses_frame_build_seconds",
+    "Time to build a frame for a browser",
+    DURATION_BUCKETS,
+)
+FRAME_BUSES = Histogram(
+    "buses_frame_buses",
+    "Buses or clusters in a frame for a browser",
+    [0, 1, 10, 100, 1000, 10_000, 100_000],
+)
+DROPPED_FRAMES = Counter(
+    "buses_dropped_frames_total",
+    "Ticks skipped because a browser was still getting the previous frame",
+)
+COALESCED_FRAMES = Counter(
+    "buses_coalesced_frames_total",
+    "Frames carrying changes of skipped ticks along with their own",
+)
+# Frames are ASCII-only JSON or bytes, so their length is their size
+SENT_BYTES = Counter("buses_sent_bytes_total", "Bytes of frames to browsers")
+Gauge(
+    "buses_browser_connections",
+    "Connected browsers",
+    lambda: len(browser_connections),
+)
+Gauge(
+    "buses_simulator_connections",
+    "Connected simulators",
+    lambda: len(simulator_connections),
+)
 
-    if bounds.errors:
-        message_to_browser = {"msgType": "Errors", "errors": bounds.errors}
+
+def use_storage(name, cluster_span=None):
+    """Replace storage of buses, columnar one requires numpy"""
+    global buses, broadcaster
+
+    if name == "columnar":
+        from columnar_storage import ColumnarBuses
+
+        buses = ColumnarBuses()
     else:
-        message_to_browser = {
-            "msgType": "Buses",
-            "buses": [
-                {
-                    "busId": bus.busId,
-                    "lat": bus.lat,
-                    "lng": bus.lng,
-                    "route": bus.busId,
-                }
-                for bus in buses_inside
-            ],
-        }
-
-    logger.debug("send_buses: inside bounds %s buses", len(buses_inside))
-    msg = json.dumps(message_to_browser)
-    await ws.send_message(msg)
-
-
-async def talk_to_browser(ws, bounds):
-    """Periodically send buses data to browser according to current bounds"""
-    while True:
+        buses = BusGrid()
+    broadcaster = Broadcaster(buses, cluster_span=cluster_span)
+
+
+async def send_frames(ws, receive_channel, connection, cancel_scope):
+    async for message in receive_channel:
         try:
-            await send_buses(ws, bounds)
+            await ws.send_message(message)
         except ConnectionClosed:
             logger.debug("*** talk_to_browser: ConnectionClosed ***")
-            break
+            cancel_scope.cancel()
+            return
+        connection.sent_frames += 1
+        SENT_BYTES.inc(len(message))
+
+
+def prepare_buses_message(bounds, feed):
+    if bounds.errors:
+        return json.dumps({"msgType": "Errors", "errors": bounds.errors})
+
+    started_at = time.perf_counter()
+    msg, buses_amount = feed.get_message(bounds)
+    if msg is not None:
+        FRAME_SECONDS.observe(time.perf_counter() - started_at)
+        FRAME_BUSES.observe(buses_amount)
+    logger.debug("send_buses: inside bounds %s buses", buses_amount)
+    return msg
+
+
+async def talk_to_browser(ws, bounds, feed, connection, hidden_tab_interval):
+    """Send buses changes to browser according to current bounds every tick.
+
+    A tick is skipped when the previous frame is still being sent to a slow
+    browser, so server keeps at most one frame per browser. Skipped changes
+    get into the next frame since the feed compares buses with sent ones.
+    """
+    # Zero-size channel accepts a frame only when the sender waits for it
+    send_channel, receive_channel = trio.open_memory_channel(0)
+    ticks_dropped = 0
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(
+            send_frames, ws, receive_channel, connection, nursery.cancel_scope
+        )
+
+        while True:
+            await broadcaster.wait_for_tick()
 
-        await trio.sleep(0.1)
+            now = trio.current_time()
+            if (
+                connection.hidden
+                and now - connection.last_sent_at < hidden_tab_interval
+            ):
+                continue
 
+            if not send_channel.statistics().tasks_waiting_receive:
+                connection.dropped_frames += 1
+                DROPPED_FRAMES.inc()
+                ticks_dropped += 1
+                continue
 
-async def listen_browser(ws, bounds):
+            msg = prepare_buses_message(bounds, feed)
+            if msg is None:
+                continue
+
+            send_channel.send_nowait(msg)
+            connection.last_sent_at = now
+            if ticks_dropped:
+                connection.coalesced_frames += 1
+                COALESCED_FRAMES.inc()
+                ticks_dropped = 0
+
+
+async def listen_browser(ws, bounds, feed, connection):
     """Receive a message with window bounds from browser and update it"""
     while True:
         try:
@@ -74,41 +190,274 @@ async def listen_browser(ws, bounds):
 
         if errors:
             bounds.register_errors(errors)
+        elif message["msgType"] == "resync":
+            feed.request_resync()
+        elif message["msgType"] == "tabVisibility":
+            connection.set_visibility(**message["data"])
         else:
             bounds.update(**message["data"])
+            feed.request_resync()
 
 
-async def handle_browser(request):
+async def handle_browser(request, hidden_tab_interval=HIDDEN_TAB_INTERVAL):
     """Responsible for communication with browser: send and receive data"""
     bounds = WindowBounds()
-    ws = await request.accept()
+    ws = await request.accept(subprotocol=choose_subprotocol(request))
+    if ws.subprotocol == SUBPROTOCOL:
+        feed = BinaryBrowserFeed(broadcaster)
+    else:
+        feed = BrowserFeed(broadcaster)
+    connection = BrowserConnection()
+    browser_connections.add(connection)
+    broadcaster.watch(bounds)
 
-    async with trio.open_nursery() as nursery:
-        nursery.start_soon(listen_browser, ws, bounds)
-        nursery.start_soon(talk_to_browser, ws, bounds)
+    try:
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(
+                talk_to_browser,
+                ws,
+                bounds,
+                feed,
+                connection,
+                hidden_tab_interval,
+            )
+            # Nothing may be sent to browser for a long time if buses stand
+            # still, so closed connection is noticed by the listener
+            await listen_browser(ws, bounds, feed, connection)
+            nursery.cancel_scope.cancel()
+    finally:
+        browser_connections.discard(connection)
+        broadcaster.unwatch(bounds)
+        logger.debug(
+            "Browser disconnected: sent %s, dropped %s, coalesced %s frames",
+            connection.sent_frames,
+            connection.dropped_frames,
+            connection.coalesced_frames,
+        )
 
 
 async def handle_simulator(request):
     """Receive data from simulator and update it in 'buses' for each bus"""
-    ws = await request.accept()
+    ws = await request.accept(subprotocol=choose_subprotocol(request))
+    bus_names = {}  # {number: (bus_id, route)} from binary messages
+    if recorder:
+        connection = recorder.open_connection(ws.subprotocol)
+    simulator_connections.add(ws)
+
+    try:
+        while True:
+            try:
+                raw_message = await ws.get_message()
+            except ConnectionClosed:
+                logger.debug("*** handle_simulator: ConnectionClosed ***")
+                if recorder:
+                    recorder.close_connection(connection)
+                break
+
+            if recorder:
+                recorder.record(connection, raw_message)
+            await receive_positions(ws, raw_message, bus_names)
+    finally:
+        simulator_connections.discard(ws)
 
+
+async def receive_positions(ws, raw_message, bus_names):
+    """Store valid positions of simulator message, report broken ones"""
+    if isinstance(raw_message, bytes) and ws.subprotocol == SUBPROTOCOL:
+        message = decode_positions(raw_message, bus_names)
+    else:
+        message = validate_message(raw_message, MessageSource.bus)
+    errors = message.get("errors")
+    SIMULATOR_MESSAGES.inc()
+
+    if errors:
+        INVALID_SIMULATOR_MESSAGES.inc()
+        # Only broken messages are logged, logging all of them costs a lot
+        logger.debug("handle_simulator: errors %s", errors)
+        error_message = json.dumps({"msgType": "Errors", "errors": errors})
+        await ws.send_message(error_message)
+
+    # Valid positions of a batch are accepted even if some others are not
+    valid_buses = get_valid_buses(message)
+    for bus_info in valid_buses:
+        buses.update(Bus(**bus_info))
+    INGESTED_POSITIONS.inc(len(valid_buses))
+
+
+async def evict_stale_buses(bus_ttl):
+    """Remove buses whose simulator has stopped sending their positions"""
     while True:
-        try:
-            json_message = await ws.get_message()
-        except ConnectionClosed:
-            logger.debug("*** handle_simulator: ConnectionClosed ***")
-            break
+        await trio.sleep(min(bus_ttl, 1))
+        evicted = buses.evict_stale(bus_ttl)
+        if evicted:
+            logger.debug("evict_stale_buses: %s buses removed", evicted)
 
-        message = validate_message(json_message, MessageSource.bus)
-        errors = message.get("errors")
 
-        logger.debug("handle_simulator: %s", message)
-        if errors:
-            error_message = json.dumps({"msgType": "Errors", "errors": errors})
-            await ws.send_message(error_message)
+async def open_reuse_port_listener(host, port):
+    """Listen the port along with other workers, kernel spreads connections"""
+    family, type_, proto, _, address = (
+        await trio.socket.getaddrinfo(host, port, type=trio.socket.SOCK_STREAM)
+    )[0]
+    sock = trio.socket.socket(family, type_, proto)
+    sock.setsockopt(trio.socket.SOL_SOCKET, trio.socket.SO_REUSEADDR, 1)
+    sock.setsockopt(trio.socket.SOL_SOCKET, trio.socket.SO_REUSEPORT, 1)
+    await sock.bind(address)
+    sock.listen()
+    return trio.SocketListener(sock)
+
+
+async def serve_reuse_port(handler, host, port):
+    listener = await open_reuse_port_listener(host, port)
+    await WebSocketServer(handler, [listener]).run()
+
+
+async def sync_shared_table(reader, tick):
+    """Copy buses changed by ingest workers into storage of this worker"""
+    while True:
+        applied = reader.sync(buses)
+        if applied:
+            logger.debug("sync_shared_table: %s buses changed", applied)
+        await trio.sleep(tick)
+
+
+async def run_ingest_worker(
+    table, worker_index, workers, address, bus_ttl, metrics_address
+):
+    global buses
+    buses = TableWriter(table, worker_index, workers)
+
+    async with trio.open_nursery() as nursery:
+        if metrics_address:
+            nursery.start_soon(serve_metrics, *metrics_address)
+        if bus_ttl:
+            nursery.start_soon(evict_stale_buses, bus_ttl)
+        nursery.start_soon(serve_reuse_port, handle_simulator, *address)
+
+
+async def run_broadcast_worker(
+    table, address, storage, cluster_span, hidden_tab_interval, metrics_address
+):
+    use_storage(storage, cluster_span)
+    reader = TableReader(table)
+
+    async with trio.open_nursery() as nursery:
+        if metrics_address:
+            nursery.start_soon(serve_metrics, *metrics_address)
+        nursery.start_soon(broadcaster.run)
+        nursery.start_soon(sync_shared_table, reader, broadcaster.tick)
+        nursery.start_soon(
+            serve_reuse_port,
+            functools.partial(
+                handle_browser, hidden_tab_interval=hidden_tab_interval
+            ),
+            *address,
+        )
+
+
+async def watch_parent(parent_pid, cancel_scope):
+    """Stop the worker once the process that started it has gone"""
+    while os.getppid() == parent_pid:
+        await trio.sleep(PARENT_CHECK_INTERVAL)
+    logger.debug("Parent process has gone, stopping the worker")
+    cancel_scope.cancel()
+
+
+async def run_role_with_parent(run_role, table, options):
+    # A killed parent can't terminate workers, they would keep its ports
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(watch_parent, os.getppid(), nursery.cancel_scope)
+        await run_role(table, **options)
+
+
+def run_worker(run_role, table_name, table_capacity, verbose, options):
+    """Entry point of an ingest or a broadcast worker process"""
+    if verbose:
+        logger.addHandler(logging.StreamHandler())
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.disabled = True
+
+    table = SharedBusTable.attach(table_name, table_capacity)
+    try:
+        with contextlib.suppress(KeyboardInterrupt):
+            trio.run(run_role_with_parent, run_role, table, options)
+    finally:
+        table.close()
+
+
+async def stop_on_signal(signals, cancel_scope):
+    async for signal_number in signals:
+        click.echo(
+            f"Got {signal.Signals(signal_number).name}, stopping the server",
+            err=True,
+        )
+        cancel_scope.cancel()
+        return
+
+
+async def run_workers(
+    ingest_workers,
+    broadcast_workers,
+    table_capacity,
+    verbose,
+    metrics_address,
+    ingest_options,
+    broadcast_options,
+):
+    """Run ingest and broadcast workers sharing bus positions in a table.
+
+    Every worker serves its own metrics on the next port after the
+    previous worker, ingest workers go first.
+    """
+    table = SharedBusTable.create(table_capacity)
+    # 'spawn' gives every worker a clean interpreter to start its own trio
+    context = multiprocessing.get_context("spawn")
+
+    roles = [
+        (
+            run_ingest_worker,
+            dict(worker_index=index, workers=ingest_workers, **ingest_options),
+        )
+        for index in range(ingest_workers)
+    ]
+    roles += [(run_broadcast_worker, broadcast_options)] * broadcast_workers
+
+    processes = []
+    for index, (run_role, options) in enumerate(roles):
+        if metrics_address:
+            host, port = metrics_address
+            options = dict(options, metrics_address=(host, port + index))
         else:
-            bus = Bus(**message["data"])
-            buses.update({bus.busId: bus})
+            options = dict(options, metrics_address=None)
+        processes.append(
+            context.Process(
+                target=run_worker,
+                args=(run_role, table.name, table_capacity, verbose, options),
+                daemon=True,
+            )
+        )
+    for process in processes:
+        process.start()
+
+    try:
+        # SIGTERM of kill, systemd or docker stops workers like Ctrl+C does
+        with trio.open_signal_receiver(signal.SIGTERM) as signals:
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(
+                    stop_on_signal, signals, nursery.cancel_scope
+                )
+                while all(process.is_alive() for process in processes):
+                    await trio.sleep(1)
+                click.echo(
+                    "A worker has stopped, stopping the server", err=True
+                )
+                nursery.cancel_scope.cancel()
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        table.close()
+        table.unlink()
 
 
 @click.command()
@@ -136,6 +485,68 @@ async def handle_simulator(request):
     type=int,
     help="Receive data from simulator through this port",
 )
+@click.option(
+    "--hidden_tab_interval",
+    default=HIDDEN_TAB_INTERVAL,
+    show_default=True,
+    type=float,
+    help="Seconds between frames to a browser tab in background",
+)
+@click.option(
+    "--bus_ttl",
+    default=BUS_TTL,
+    show_default=True,
+    type=float,
+    help="Remove a bus not updated for that many seconds, 0 to keep forever",
+)
+@click.option(
+    "--storage",
+    default="grid",
+    show_default=True,
+    type=click.Choice(STORAGES),
+    help="Storage of buses: grid of cells or numpy columns for large fleets",
+)
+@click.option(
+    "--cluster_span",
+    default=CLUSTER_SPAN,
+    show_default=True,
+    type=float,
+    help="Send clusters instead of buses to a browser showing more degrees "
+    "than that, 0 to send buses always",
+)
+@click.option(
+    "--record",
+    type=click.Path(dir_okay=False),
+    help="Append messages of simulators to this compressed log for replay.py",
+)
+@click.option(
+    "--metrics_port",
+    default=0,
+    show_default=True,
+    type=int,
+    help="Serve metrics over HTTP at /metrics on this port, 0 to turn off",
+)
+@click.option(
+    "--ingest_workers",
+    default=0,
+    show_default=True,
+    type=int,
+    help="Processes receiving data from simulators, 0 to run in one process",
+)
+@click.option(
+    "--broadcast_workers",
+    default=0,
+    show_default=True,
+    type=int,
+    help="Processes sending data to browsers, 0 to run in one process",
+)
+@click.option(
+    "--table_capacity",
+    default=TABLE_CAPACITY,
+    show_default=True,
+    type=int,
+    help="Max amount of buses shared among worker processes",
+)
 @click.option(
     "--verbose",
     "-v",
@@ -144,19 +555,71 @@ async def handle_simulator(request):
     help="Enable logging",
     show_default=True,
 )
-async def main(host, browser_port, simulator_port, verbose):
+async def main(
+    host,
+    browser_port,
+    simulator_port,
+    hidden_tab_interval,
+    bus_ttl,
+    storage,
+    cluster_span,
+    record,
+    metrics_port,
+    ingest_workers,
+    broadcast_workers,
+    table_capacity,
+    verbose,
+):
+    global recorder
+
     simulator_address = (host, simulator_port)
     browser_address = (host, browser_port)
+    metrics_address = (host, metrics_port) if metrics_port else None
 
     if not verbose:
         logger.disabled = True
+    cluster_span = cluster_span or None
+
+    if ingest_workers or broadcast_workers:
+        if record:
+            raise click.UsageError("--record works in one process only")
+        await run_workers(
+            max(ingest_workers, 1),
+            max(broadcast_workers, 1),
+            table_capacity,
+            verbose,
+            metrics_address,
+            ingest_options={"address": simulator_address, "bus_ttl": bus_ttl},
+            broadcast_options={
+                "address": browser_address,
+                "storage": storage,
+                "cluster_span": cluster_span,
+                "hidden_tab_interval": hidden_tab_interval,
+            },
+        )
+        return
+
+    use_storage(storage, cluster_span)
 
     async with trio.open_nursery() as nursery:
+        if record:
+            recorder = TrafficRecorder(record)
+            nursery.start_soon(recorder.run)
+        if metrics_address:
+            nursery.start_soon(serve_metrics, *metrics_address)
+        nursery.start_soon(broadcaster.run)
+        if bus_ttl:
+            nursery.start_soon(evict_stale_buses, bus_ttl)
         nursery.start_soon(
             serve_websocket, handle_simulator, *simulator_address, None
         )
         nursery.start_soon(
-            serve_websocket, handle_browser, *browser_address, None
+            serve_websocket,
+            functools.partial(
+                handle_browser, hidden_tab_interval=hidden_tab_interval
+            ),
+            *browser_address,
+            None,
         )
 
 
@@ -0,0 +1,206 @@
+"""Table of bus positions in shared memory for server worker processes.
+
+Table has fixed capacity and is laid out by columns:
+    versions (uint64) | lats (float64) | lngs (float64) | bus ids | routes
+
+Every ingest worker owns its own region of slots and is the only writer
+there, so writers never lock. Version of a slot is odd while the slot is
+being written, and readers retry a slot whose version is odd or has changed
+during the read. Slot with empty bus id is free.
+"""
+
+import itertools
+import operator
+from multiprocessing import shared_memory
+
+from models import Bus
+from storage import UpdateTimes
+
+BUS_ID_SIZE = 64  # bytes of utf8 encoded bus id, padded with zeros
+ROUTE_SIZE = 32
+COLUMNS = [("versions", 8), ("lats", 8), ("lngs", 8)]
+
+
+def get_table_size(capacity):
+    return capacity * (
+        sum(size for _, size in COLUMNS) + BUS_ID_SIZE + ROUTE_SIZE
+    )
+
+
+def decode_text(raw):
+    return raw.rstrip(b"\0").decode()
+
+
+class SharedBusTable:
+    def __init__(self, shared_memory_block, capacity):
+        self.shared_memory = shared_memory_block
+        self.capacity = capacity
+
+        buffer = shared_memory_block.buf
+        offset = 0
+        for name, size in COLUMNS:
+            column = buffer[offset : offset + capacity * size]
+            setattr(self, name, column.cast("Q" if name == "versions" else "d"))
+            offset += capacity * size
+
+        self.bus_ids = buffer[offset : offset + capacity * BUS_ID_SIZE]
+        offset += capacity * BUS_ID_SIZE
+        self.routes = buffer[offset : offset + capacity * ROUTE_SIZE]
+
+    @classmethod
+    def create(cls, capacity):
+        shared_memory_block = shared_memory.SharedMemory(
+            create=True, size=get_table_size(capacity)
+        )
+        return cls(shared_memory_block, capacity)
+
+    @classmethod
+    def attach(cls, name, capacity):
+        return cls(shared_memory.SharedMemory(name=name), capacity)
+
+    @property
+    def name(self):
+        return self.shared_memory.name
+
+    def close(self):
+        # Shared memory can't be closed while views of it exist
+        for name in ["versions", "lats", "lngs", "bus_ids", "routes"]:
+            getattr(self, name).release()
+        self.shared_memory.close()
+
+    def unlink(self):
+        self.shared_memory.unlink()
+
+    def write(self, slot, bus_id, route, lat, lng):
+        """Write encoded bus id and route into the slot, empty id frees it"""
+        bus_id_start, route_start = slot * BUS_ID_SIZE, slot * ROUTE_SIZE
+
+        self.versions[slot] += 1
+        self.lats[slot] = lat
+        self.lngs[slot] = lng
+        self.bus_ids[bus_id_start : bus_id_start + BUS_ID_SIZE] = bus_id.ljust(
+            BUS_ID_SIZE, b"\0"
+        )
+        self.routes[route_start : route_start + ROUTE_SIZE] = route.ljust(
+            ROUTE_SIZE, b"\0"
+        )
+        self.versions[slot] += 1
+
+    def read(self, slot):
+        """Return (bus_id, route, lat, lng) of the slot and its version.
+
+        None is returned instead when the slot is being written right now.
+        """
+        bus_id_start, route_start = slot * BUS_ID_SIZE, slot * ROUTE_SIZE
+
+        version = self.versions[slot]
+        if version % 2:
+            return None
+
+        bus_id = bytes(self.bus_ids[bus_id_start : bus_id_start + BUS_ID_SIZE])
+        route = bytes(self.routes[route_start : route_start + ROUTE_SIZE])
+        lat, lng = self.lats[slot], self.lngs[slot]
+
+        # Text is decoded after the check, torn bytes may be not utf8 at all
+        if self.versions[slot] != version:
+            return None
+        return (decode_text(bus_id), decode_text(route), lat, lng), version
+
+
+class TableWriter:
+    """Storage of an ingest worker writing buses into its region of table"""
+
+    def __init__(self, table, worker_index, workers):
+        self.table = table
+        region_size = table.capacity // workers
+        region_start = worker_index * region_size
+        self.free_slots = list(
+            reversed(range(region_start, region_start + region_size))
+        )
+
+        self.slots = {}  # {bus_id: slot}
+        self.update_times = UpdateTimes()
+        self.rejected = 0  # buses which don't fit into the table
+
+    def __len__(self):
+        return len(self.slots)
+
+    def update(self, bus):
+        bus_id = bus.busId.encode()
+        route = bus.route.encode()
+        slot = self.slots.get(bus.busId)
+
+        if len(bus_id) > BUS_ID_SIZE or len(route) > ROUTE_SIZE:
+            self.rejected += 1
+            return
+        if slot is None:
+            if not self.free_slots:
+                self.rejected += 1
+                return
+            slot = self.slots[bus.busId] = self.free_slots.pop()
+
+        self.table.write(slot, bus_id, route, bus.lat, bus.lng)
+        self.update_times.touch(bus.busId)
+
+    def remove(self, bus_id):
+        self.update_times.discard(bus_id)
+        slot = self.slots.pop(bus_id, None)
+        if slot is not None:
+            self.table.write(slot, b"", b"", 0.0, 0.0)
+            self.free_slots.append(slot)
+
+    def evict_stale(self, max_age):
+        """Remove buses not updated for max_age seconds, return amount"""
+        stale_bus_ids = self.update_times.pop_stale(max_age)
+        for bus_id in stale_bus_ids:
+            self.remove(bus_id)
+        return len(stale_bus_ids)
+
+
+class TableReader:
+    """Copy buses changed in the table into a local storage of a process"""
+
+    def __init__(self, table):
+        self.table = table
+        self.seen_versions = [0] * table.capacity
+        self.slot_bus_ids = {}  # {slot: bus_id} as the storage has it now
+        # Bus moved to another ingest worker may remain in its old slot
+        # for a while, the slot updated last wins then
+        self.bus_slots = {}  # {bus_id: slot}
+
+    def _forget_slot(self, slot, storage):
+        bus_id = self.slot_bus_ids.pop(slot, None)
+        if bus_id is not None and self.bus_slots.get(bus_id) == slot:
+            del self.bus_slots[bus_id]
+            storage.remove(bus_id)
+
+    def sync(self, storage):
+        """Apply changes of the table to the storage, return their amount"""
+        versions = self.table.versions.tolist()
+        changed_slots = list(
+            itertools.compress(
+                range(len(versions)),
+                map(operator.ne, versions, self.seen_versions),
+            )
+        )
+
+        applied = 0
+        for slot in changed_slots:
+            result = self.table.read(slot)
+            if result is None:
+                continue  # being written, will be read next time
+
+            (bus_id, route, lat, lng), version = result
+            self.seen_versions[slot] = version
+            applied += 1
+
+            if self.slot_bus_ids.get(slot) != bus_id:
+                self._forget_slot(slot, storage)
+            if not bus_id:
+                continue
+
+            self.slot_bus_ids[slot] = bus_id
+            self.bus_slots[bus_id] = slot
+            storage.update(Bus(busId=bus_id, route=route, lat=lat, lng=lng))
+
+        return applied
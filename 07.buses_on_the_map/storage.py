@@ -0,0 +1,301 @@
+import math
+import time
+from collections import OrderedDict, defaultdict
+
+# Cell sizes of cluster levels, every level is 4 times coarser than previous
+CLUSTER_CELL_SIZES = (0.02, 0.08, 0.32, 1.28)
+# Clusters across the longer side of bounds at most, so amount of clusters
+# depends on the screen rather than on the fleet
+CLUSTERS_ACROSS = 32
+
+
+class UpdateTimes:
+    """Time of the last update of every bus, the oldest ones go first.
+
+    Update times only grow, so moving an updated bus to the end keeps the
+    order, and stale buses are found without looking at the live ones.
+    """
+
+    def __init__(self):
+        self.updated_at = OrderedDict()  # {bus_id: monotonic time}
+
+    def touch(self, bus_id):
+        self.updated_at[bus_id] = time.monotonic()
+        self.updated_at.move_to_end(bus_id)
+
+    def discard(self, bus_id):
+        self.updated_at.pop(bus_id, None)
+
+    def pop_stale(self, max_age):
+        """Forget and return ids of buses not updated for max_age seconds"""
+        deadline = time.monotonic() - max_age
+        stale_bus_ids = []
+        for bus_id, updated_at in self.updated_at.items():
+            if updated_at >= deadline:
+                break
+            stale_bus_ids.append(bus_id)
+
+        for bus_id in stale_bus_ids:
+            del self.updated_at[bus_id]
+        return stale_bus_ids
+
+
+class RouteIndex:
+    """Buses of every route to answer bounds queries filtered by routes"""
+
+    def __init__(self):
+        self.route_buses = defaultdict(dict)  # {route: {bus_id: bus_info}}
+
+    def add(self, bus, previous_bus=None):
+        if previous_bus is not None and previous_bus.route != bus.route:
+            self.discard(previous_bus)
+        self.route_buses[bus.route][bus.busId] = bus
+
+    def discard(self, bus):
+        route_buses = self.route_buses.get(bus.route)
+        if route_buses is None:
+            return
+        route_buses.pop(bus.busId, None)
+        if not route_buses:
+            del self.route_buses[bus.route]
+
+    def get_buses_inside(self, bounds):
+        """Return buses of bounds routes inside bounds, others are skipped"""
+        return [
+            bus
+            for route in bounds.routes
+            for bus in self.route_buses.get(route, {}).values()
+            if bounds.is_inside(bus.lat, bus.lng)
+        ]
+
+
+class ClusterIndex:
+    """Count and sums of coordinates of buses per cell on several levels.
+
+    Aggregates are updated with every bus, so centroids of cells are ready
+    without walking over buses when a browser looks at the whole city.
+    """
+
+    def __init__(self, cell_sizes=CLUSTER_CELL_SIZES):
+        # [(cell_size, {(row, col): [count, lat_sum, lng_sum]})]
+        self.levels = [(cell_size, {}) for cell_size in cell_sizes]
+
+    def add(self, bus, previous_bus=None):
+        for cell_size, cells in self.levels:
+            cell = (
+                math.floor(bus.lat / cell_size),
+                math.floor(bus.lng / cell_size),
+            )
+            if previous_bus is not None:
+                previous_cell = (
+                    math.floor(previous_bus.lat / cell_size),
+                    math.floor(previous_bus.lng / cell_size),
+                )
+                if previous_cell == cell:
+                    # Most updates move a bus within its cell on all levels
+                    aggregate = cells[cell]
+                    aggregate[1] += bus.lat - previous_bus.lat
+                    aggregate[2] += bus.lng - previous_bus.lng
+                    continue
+                self._discard_from_cell(cells, previous_cell, previous_bus)
+
+            aggregate = cells.get(cell)
+            if aggregate is None:
+                cells[cell] = [1, bus.lat, bus.lng]
+            else:
+                aggregate[0] += 1
+                aggregate[1] += bus.lat
+                aggregate[2] += bus.lng
+
+    def _discard_from_cell(self, cells, cell, bus):
+        aggregate = cells.get(cell)
+        if aggregate is None:
+            return
+        if aggregate[0] == 1:
+            # Sums are dropped with the last bus, no rounding errors pile up
+            del cells[cell]
+        else:
+            aggregate[0] -= 1
+            aggregate[1] -= bus.lat
+            aggregate[2] -= bus.lng
+
+    def discard(self, bus):
+        for cell_size, cells in self.levels:
+            cell = (
+                math.floor(bus.lat / cell_size),
+                math.floor(bus.lng / cell_size),
+            )
+            self._discard_from_cell(cells, cell, bus)
+
+    def get_clusters(self, bounds, clusters_across=CLUSTERS_ACROSS):
+        """Return [(lat, lng, count)] of cells overlapping bounds.
+
+        The finest level giving at most clusters_across cells along the
+        longer side of bounds is used.
+        """
+        span = max(
+            bounds.north_lat - bounds.south_lat,
+            bounds.east_lng - bounds.west_lng,
+        )
+        for cell_size, cells in self.levels:
+            if span / cell_size <= clusters_across:
+                break
+
+        south_row = math.floor(bounds.south_lat / cell_size)
+        north_row = math.floor(bounds.north_lat / cell_size)
+        west_col = math.floor(bounds.west_lng / cell_size)
+        east_col = math.floor(bounds.east_lng / cell_size)
+        return [
+            (lat_sum / count, lng_sum / count, count)
+            for (row, col), (count, lat_sum, lng_sum) in cells.items()
+            if south_row <= row <= north_row and west_col <= col <= east_col
+        ]
+
+
+class BusGrid:
+    """Buses spread over a uniform lat/lng grid to answer bounds queries.
+
+    Every bus lives in exactly one cell, so a query only touches the cells
+    that overlap the window bounds instead of the whole fleet.
+    """
+
+    batch_queries = False  # every browser is queried on its own
+
+    def __init__(self, cell_size=0.01):
+        self.cell_size = cell_size
+        self.buses = {}  # {bus_id: bus_info}
+        self.bus_cells = {}  # {bus_id: (row, col)}
+        self.cells = defaultdict(dict)  # {(row, col): {bus_id: bus_info}}
+        self.route_index = RouteIndex()
+        self.cluster_index = ClusterIndex()
+        self.update_times = UpdateTimes()
+
+        # What has been touched since the last call of 'pop_changes'
+        self.changed_buses = set()
+        self.changed_cells = set()
+
+    def __len__(self):
+        return len(self.buses)
+
+    def __iter__(self):
+        return iter(self.buses.values())
+
+    def get_cell(self, lat, lng):
+        return (
+            math.floor(lat / self.cell_size),
+            math.floor(lng / self.cell_size),
+        )
+
+    def update(self, bus):
+        """Add a new bus or move an existing one to its current cell"""
+        cell = self.get_cell(bus.lat, bus.lng)
+        previous_cell = self.bus_cells.get(bus.busId)
+
+        if previous_cell is not None and previous_cell != cell:
+            self._discard_from_cell(previous_cell, bus.busId)
+            self.changed_cells.add(previous_cell)
+
+        previous_bus = self.buses.get(bus.busId)
+        self.route_index.add(bus, previous_bus)
+        self.cluster_index.add(bus, previous_bus)
+        self.buses[bus.busId] = bus
+        self.bus_cells[bus.busId] = cell
+        self.cells[cell][bus.busId] = bus
+
+        self.changed_buses.add(bus.busId)
+        self.changed_cells.add(cell)
+        self.update_times.touch(bus.busId)
+
+    def remove(self, bus_id):
+        bus = self.buses.pop(bus_id, None)
+        if bus is not None:
+            self.route_index.discard(bus)
+            self.cluster_index.discard(bus)
+        self.update_times.discard(bus_id)
+        cell = self.bus_cells.pop(bus_id, None)
+        if cell is not None:
+            self._discard_from_cell(cell, bus_id)
+            self.changed_buses.add(bus_id)
+            self.changed_cells.add(cell)
+
+    def evict_stale(self, max_age):
+        """Remove buses not updated for max_age seconds, return amount"""
+        stale_bus_ids = self.update_times.pop_stale(max_age)
+        for bus_id in stale_bus_ids:
+            self.remove(bus_id)
+        return len(stale_bus_ids)
+
+    def pop_changes(self):
+        """Return ids of changed buses and cells and start tracking anew"""
+        changes = self.changed_buses, self.changed_cells
+        self.changed_buses, self.changed_cells = set(), set()
+        return changes
+
+    def _discard_from_cell(self, cell, bus_id):
+        cell_buses = self.cells[cell]
+        cell_buses.pop(bus_id, None)
+        if not cell_buses:
+            del self.cells[cell]
+
+    def get_cells_inside(self, bounds):
+        """Yield (cell, is_border) for every non-empty cell overlapping bounds.
+
+        Buses of inner cells are inside bounds for sure, buses of border
+        cells have to be checked one by one.
+        """
+        south_row, west_col = self.get_cell(bounds.south_lat, bounds.west_lng)
+        north_row, east_col = self.get_cell(bounds.north_lat, bounds.east_lng)
+
+        if south_row > north_row or west_col > east_col:
+            return
+
+        cells_in_bounds = (north_row - south_row + 1) * (
+            east_col - west_col + 1
+        )
+
+        if cells_in_bounds > len(self.cells):
+            # Huge window: cheaper to walk over non-empty cells only
+            candidates = [
+                cell
+                for cell in self.cells
+                if south_row <= cell[0] <= north_row
+                and west_col <= cell[1] <= east_col
+            ]
+        else:
+            candidates = [
+                (row, col)
+                for row in range(south_row, north_row + 1)
+                for col in range(west_col, east_col + 1)
+                if (row, col) in self.cells
+            ]
+
+        for row, col in candidates:
+            is_border = row in (south_row, north_row) or col in (
+                west_col,
+                east_col,
+            )
+            yield (row, col), is_border
+
+    def get_buses_inside(self, bounds):
+        if bounds.routes:
+            return self.route_index.get_buses_inside(bounds)
+
+        buses_inside = []
+        for cell, is_border in self.get_cells_inside(bounds):
+            cell_buses = self.cells[cell].values()
+            if is_border:
+                buses_inside.extend(
+                    bus
+                    for bus in cell_buses
+                    if bounds.is_inside(bus.lat, bus.lng)
+                )
+            else:
+                buses_inside.extend(cell_buses)
+        return buses_inside
+
+    def get_bus_ids_inside_many(self, bounds_list):
+        """Return list of bus ids inside every bounds of the list"""
+        return [
+            [bus.busId for bus in self.get_buses_inside(bounds)]
+            for bounds in bounds_list
+        ]
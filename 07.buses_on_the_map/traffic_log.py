@@ -0,0 +1,130 @@
+"""Append-only compressed log of messages from simulators.
+
+Log is a gzip file, every write appends a complete gzip member of its own,
+so a killed server loses only records not written yet, and sessions
+appended after it are readable. Records are laid out as:
+
+    kind (uint8) | seconds since session start (float64)
+    | connection number (uint32) | payload length (uint32) | payload
+
+Session starts with a SESSION record holding MAGIC, connection of a
+simulator starts with OPEN record holding accepted websocket subprotocol
+and ends with CLOSE one. Time is monotonic and goes on across sessions
+when the log is read.
+"""
+
+import gzip
+import itertools
+import struct
+import time
+import zlib
+
+import trio
+
+MAGIC = b"BUSLOG1"
+RECORD = struct.Struct("<BdII")
+
+SESSION = 0
+OPEN = 1
+TEXT = 2
+BINARY = 3
+CLOSE = 4
+
+
+class TrafficRecorder:
+    """Collect messages of simulators and append them to the log.
+
+    Records are packed in memory and written by a thread once in a while,
+    so compression doesn't hold up receiving of messages.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        self.file = open(path, "ab")
+        self.flush_interval = flush_interval
+        self.started_at = time.monotonic()
+        self.connection_counter = itertools.count()
+        self.pending = []
+        self.add_record(SESSION, 0, MAGIC)
+
+    def add_record(self, kind, connection, payload=b""):
+        timestamp = time.monotonic() - self.started_at
+        self.pending.append(
+            RECORD.pack(kind, timestamp, connection, len(payload)) + payload
+        )
+
+    def open_connection(self, subprotocol=None):
+        """Return number of a new connection to record its messages with"""
+        connection = next(self.connection_counter)
+        self.add_record(OPEN, connection, (subprotocol or "").encode())
+        return connection
+
+    def record(self, connection, message):
+        if isinstance(message, str):
+            self.add_record(TEXT, connection, message.encode())
+        else:
+            self.add_record(BINARY, connection, message)
+
+    def close_connection(self, connection):
+        self.add_record(CLOSE, connection)
+
+    def pop_pending(self):
+        pending, self.pending = self.pending, []
+        return b"".join(pending)
+
+    def write(self, records):
+        if records:
+            self.file.write(gzip.compress(records))
+            self.file.flush()
+
+    async def run(self):
+        """Write collected records every flush_interval seconds"""
+        try:
+            while True:
+                await trio.sleep(self.flush_interval)
+                await trio.to_thread.run_sync(self.write, self.pop_pending())
+        finally:
+            self.write(self.pop_pending())
+            self.file.close()
+
+
+def read_exactly(file, size):
+    """Return size bytes of the log, fewer only at its end"""
+    try:
+        return file.read(size)
+    except (EOFError, zlib.error, gzip.BadGzipFile):
+        # Last member is unfinished or broken by a server killed writing it
+        raise ValueError("Log is cut off")
+
+
+def read_records(path):
+    """Yield (kind, time, connection, payload) of all sessions of the log.
+
+    Connection is (session number, connection number), so connections
+    of different sessions never mix up.
+    """
+    with gzip.open(path, "rb") as file:
+        session = -1
+        time_offset = last_time = 0.0
+        while True:
+            header = read_exactly(file, RECORD.size)
+            if not header:
+                return
+            if len(header) != RECORD.size:
+                raise ValueError("Log is cut off")
+
+            kind, timestamp, connection, length = RECORD.unpack(header)
+            payload = read_exactly(file, length)
+            if len(payload) != length:
+                raise ValueError("Log is cut off")
+
+            if kind == SESSION:
+                if payload != MAGIC:
+                    raise ValueError("Not a log of simulator messages")
+                session += 1
+                time_offset = last_time
+                continue
+            if session < 0:
+                raise ValueError("Not a log of simulator messages")
+
+            last_time = time_offset + timestamp
+            yield kind, last_time, (session, connection), payload
@@ -1,15 +1,20 @@
-import os
 import json
+import math
 
-from schema import WindowBoundsSchema, BusSchema
+from marshmallow import ValidationError
+
+from route_cache import load_cached_routes
+from schema import (
+    BusSchema,
+    ResyncSchema,
+    TabVisibilitySchema,
+    WindowBoundsSchema,
+)
 
 
 def load_routes(directory_path="routes"):
-    for filename in os.listdir(directory_path):
-        if filename.endswith(".json"):
-            filepath = os.path.join(directory_path, filename)
-            with open(filepath, "r", encoding="utf8") as file:
-                yield json.load(file)
+    """Return routes with their names and coordinates from binary cache"""
+    return load_cached_routes(directory_path)
 
 
 def generate_bus_id(emulator_id, route_id, bus_index):
@@ -18,18 +23,102 @@ def generate_bus_id(emulator_id, route_id, bus_index):
     return f"{route_id}-{bus_index}"
 
 
+# Schemas keep no state between validations, so they are created only once
+bus_schema = BusSchema()
+window_bounds_schema = WindowBoundsSchema()
+resync_schema = ResyncSchema()
+tab_visibility_schema = TabVisibilitySchema()
+
+BUS_FIELDS = frozenset(bus_schema.fields)
+
+
+def is_valid_bus(bus_info):
+    """Fast check of a bus position in the shape simulator sends it.
+
+    It passes only data that BusSchema accepts as well. Anything else is not
+    necessarily broken and has to be validated by BusSchema to get errors.
+    """
+    return (
+        type(bus_info) is dict
+        and bus_info.keys() == BUS_FIELDS
+        and type(bus_info["busId"]) is str
+        and type(bus_info["route"]) is str
+        and type(bus_info["lat"]) is float
+        and type(bus_info["lng"]) is float
+        and math.isfinite(bus_info["lat"])
+        and math.isfinite(bus_info["lng"])
+    )
+
+
+def load_bus(bus_info):
+    """Return errors of bus position, convert its fields to their types.
+
+    Position could pass validation with "55.7" as latitude, so it's stored
+    as converted by BusSchema to be put into the grid.
+    """
+    try:
+        loaded = bus_schema.load(bus_info)
+    except ValidationError as error:
+        return error.messages
+    bus_info.update(loaded)
+    return {}
+
+
 def validate_bus_message(message):
-    schema = BusSchema()
-    return schema.validate(data=message)
+    if not isinstance(message, list):
+        if is_valid_bus(message):
+            return {}
+        return load_bus(message)
+
+    # Batch of positions from simulator is validated item by item,
+    # errors are grouped by index of the broken item
+    errors = {}
+    for index, bus_info in enumerate(message):
+        if is_valid_bus(bus_info):
+            continue
+        bus_errors = load_bus(bus_info)
+        if bus_errors:
+            errors[index] = bus_errors
+    return errors
 
 
 def validate_client_message(message):
-    schema = WindowBoundsSchema()
-    return schema.validate(data=message)
+    """Return errors of browser message, convert its fields to their types.
+
+    Bounds have to be floats to be compared, "55.7" passes validation too.
+    """
+    client_schemas = {
+        "resync": resync_schema,
+        "tabVisibility": tab_visibility_schema,
+    }
+    msg_type = message.get("msgType") if isinstance(message, dict) else None
+    # Unknown messages are reported as broken bounds like they always were
+    schema = client_schemas.get(msg_type, window_bounds_schema)
+    try:
+        loaded = schema.load(message)
+    except ValidationError as error:
+        return error.messages
+    message.update(loaded)
+    return {}
+
+
+def get_valid_buses(message):
+    """Return bus positions of validated message that have no errors"""
+    data, errors = message["data"], message["errors"]
+
+    if isinstance(data, list):
+        return [
+            bus_info
+            for index, bus_info in enumerate(data)
+            if index not in errors
+        ]
+    if errors:
+        return []
+    return [data]
 
 
 def validate_message(json_message, source):
-    result = {"data": json_message, "errors": None}
+    result = {"data": json_message, "errors": None, "msgType": None}
 
     try:
         message = json.loads(json_message)
@@ -37,16 +126,20 @@ def validate_message(json_message, source):
         result["errors"] = ["Requires valid JSON"]
         return result
 
-    result["data"] = message.get("data", message)
-
-    validating_functions = {
-        "bus": validate_bus_message,
-        "browser": validate_client_message,
-    }
-    validating_function = validating_functions.get(source.value)
+    if isinstance(message, dict):
+        result["data"] = message.get("data", message)
+        result["msgType"] = message.get("msgType")
+    else:
+        result["data"] = message
 
-    if not validating_function:
-        result["errors"] = ["Data source is not correct"]
+    # Positions are validated as they are returned, the wrapper is dropped,
+    # browser messages are validated whole along with their msgType
+    if source.value == "bus":
+        result["errors"] = validate_bus_message(result["data"])
+    elif source.value == "browser":
+        result["errors"] = validate_client_message(message)
+        if isinstance(message, dict):
+            result["data"] = message.get("data", message)
     else:
-        result["errors"] = validating_function(message)
+        result["errors"] = ["Data source is not correct"]
     return result